@@ -13,19 +13,66 @@ New in v3:
 """
 
 import os
+import io
+import zlib
+import math
+import heapq
+import hmac
+import hashlib
+import threading
 import re
 import random
 import json
 import time
+import csv
+import functools
 import streamlit as st
 import pdfplumber
+import numpy as np
+import pandas as pd
 import google.generativeai as genai
 from dotenv import load_dotenv
 from datetime import datetime, date
+from collections import OrderedDict
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor, as_completed,
+                                wait as wait_futures, FIRST_COMPLETED)
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
+
+# ──────────────────────────────────────────────────────────────────────────────
+# PROCESS-WIDE STATE
+# ──────────────────────────────────────────────────────────────────────────────
+#
+# Streamlit re-executes this file on every rerun, so plain module globals are
+# rebuilt each time. Anything that must be shared by every session in the
+# server process (caches, the rate limiter, counters) lives in this registry,
+# which st.cache_resource keeps alive for the life of the process.
+# ──────────────────────────────────────────────────────────────────────────────
+
+@st.cache_resource(show_spinner=False)
+def _process_registry():
+    return {}
+
+
+def shared(name, factory):
+    """The process-wide object called `name`, created by `factory()` the first time."""
+    registry = _process_registry()
+    if name not in registry:
+        registry.setdefault(name, factory())    # setdefault: first writer wins
+    return registry[name]
+
+
+_stats_lock = shared("stats_lock", threading.Lock)
+
+
+def bump(stats, key, n=1):
+    """Add `n` to a shared counter; sessions and worker threads update them at once."""
+    with _stats_lock:
+        stats[key] += n
+
 # ──────────────────────────────────────────────────────────────────────────────
 # CSS
 # ──────────────────────────────────────────────────────────────────────────────
@@ -121,6 +168,8 @@ footer{visibility:hidden;}
 .chat-ai{background:white;border:1px solid #E2E8F0;color:#1E293B;
   border-radius:14px 14px 14px 4px;padding:10px 16px;margin:6px 0;
   max-width:85%;font-size:.88rem;box-shadow:0 1px 4px rgba(0,0,0,.06);}
+.chat-badge{display:inline-block;background:#FEF3C7;color:#92400E;border-radius:6px;
+  padding:1px 8px;margin-bottom:6px;font-size:.72rem;font-weight:600;}
 
 /* Timer */
 .timer-ok{background:#D1FAE5;border-radius:10px;padding:10px 20px;
@@ -220,6 +269,8 @@ def init_session_state():
         "nav_section":   "files",
         "global_chat":   [],       # list of {role, content}
         "context_chat":  [],       # contextual chat messages
+        "global_memory": new_chat_memory(),     # summary of older global_chat turns
+        "context_memory": new_chat_memory(),
     }
     for k, v in defaults.items():
         if k not in st.session_state:
@@ -242,7 +293,13 @@ def set_key(key, value):
 def empty_course():
     return {
         "chunks":             [],
+        "chunk_meta":         [],      # Chunk records, parallel to chunks
         "file_names":         [],
+        "doc_ids":            [],      # content hash prefix, parallel to file_names
+        "bm25":               None,    # inverted index over chunks
+        "tfidf":              None,    # hashed TF-IDF matrix over chunks
+        "lsh":                None,    # MinHash/LSH index for near-duplicates
+        "dedup_stats":        {"chunks": 0, "tokens": 0},
         "study_guide":        "",
         "flashcards":         [],      # list of {front, back}
         "exercises":          [],      # list of question dicts
@@ -254,6 +311,8 @@ def empty_course():
         "test_start_time":    None,
         "test_submitted":     False,
         "diagnostic":         "",
+        "prefetch":           {},      # kind -> background job (see start_prefetch)
+        "question_bank":      None,    # see QUESTION BANK
         "notebook_sessions":  list(EXAMPLE_NOTES),  # pre-fill with examples
     }
 
@@ -264,6 +323,232 @@ def go(page, section=None):
         st.session_state.nav_section = section
 
 
+# ──────────────────────────────────────────────────────────────────────────────
+# DISK CACHE HELPERS
+# ──────────────────────────────────────────────────────────────────────────────
+#
+# Shared by the extracted-text cache and the AI response cache: one JSON file
+# per entry, written atomically, with the file mtime as the LRU timestamp.
+# ──────────────────────────────────────────────────────────────────────────────
+
+CACHE_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+
+def write_text_atomic(path, text):
+    """Write `text` via a temp file + rename. Returns False on I/O errors."""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8", newline="") as fh:
+            fh.write(text)
+        os.replace(tmp, path)           # atomic — no half-written entries
+    except OSError:
+        return False
+    return True
+
+
+def write_json_atomic(path, obj):
+    """Write `obj` as JSON via a temp file + rename. Returns False on I/O errors."""
+    return write_text_atomic(path, json.dumps(obj))
+
+
+def evict_lru_files(directory, max_bytes):
+    """
+    Delete least-recently-used .json files until `directory` fits `max_bytes`.
+    Returns (files evicted, bytes left).
+    """
+    try:
+        entries = []
+        for fn in os.listdir(directory):
+            if fn.endswith(".json"):
+                stat = os.stat(os.path.join(directory, fn))
+                entries.append((stat.st_mtime, stat.st_size, fn))
+    except OSError:
+        return 0, 0
+    total, evicted = sum(size for _, size, _ in entries), 0
+    for _, size, fn in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(directory, fn))
+            total   -= size
+            evicted += 1
+        except OSError:
+            pass
+    return evicted, total
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# TELEMETRY
+# ──────────────────────────────────────────────────────────────────────────────
+#
+# Every call_ai call is recorded under a label: the name given by the
+# @instrumented generate_* / grade_* / chat_* function it runs inside, else its
+# call type. Per label we keep counters (calls, cache hits, coalesced calls,
+# retries, errors by class), token totals from usage_metadata, an estimated
+# list-price cost, and fixed-bucket histograms. Snapshots are written to
+# TELEMETRY_DIR as JSON, CSV and Prometheus text at most once per
+# TELEMETRY_FLUSH_SECONDS, and shown on the admin page (ADMIN_PAGE=on), which
+# asks for ADMIN_TOKEN and stays locked when none is set.
+# ──────────────────────────────────────────────────────────────────────────────
+
+TELEMETRY_DIR           = os.getenv("TELEMETRY_DIR", os.path.join(CACHE_ROOT, "telemetry"))
+TELEMETRY_FLUSH_SECONDS = 60
+ADMIN_PAGE              = os.getenv("ADMIN_PAGE", "off") == "on"
+ADMIN_TOKEN             = os.getenv("ADMIN_TOKEN", "")
+
+HISTOGRAMS = {                          # name -> bucket upper bounds (+Inf implied)
+    "call_seconds":    [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 90],
+    "task_seconds":    [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 90],
+    "prompt_tokens":   [128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768],
+    "response_tokens": [64, 128, 256, 512, 1024, 2048, 4096],
+    "cost_usd":        [0.00001, 0.0001, 0.001, 0.01, 0.1],
+}
+# Approximate paid-tier list prices, USD per 1M tokens (input, output).
+MODEL_PRICES = {
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.0-flash": (0.10, 0.40),
+    "gemini-1.5-flash": (0.075, 0.30),
+    "gemini-1.5-pro":   (1.25, 5.00),
+}
+
+_telemetry  = shared("telemetry", lambda: {"lock": threading.Lock(), "labels": {},
+                                           "started": time.time(), "flushed": time.time()})
+_call_label = threading.local()         # .name = label of the instrumented function running
+
+
+def _label_stats(label):
+    """Counters for `label` (caller holds the telemetry lock)."""
+    return _telemetry["labels"].setdefault(label, {
+        "calls": 0, "tasks": 0, "cache_hits": 0, "coalesced": 0, "retries": 0,
+        "errors": {}, "prompt_tokens": 0, "response_tokens": 0, "cost_usd": 0.0,
+        "models": {},
+        "hist": {name: {"buckets": [0] * (len(bounds) + 1), "sum": 0.0, "count": 0}
+                 for name, bounds in HISTOGRAMS.items()},
+    })
+
+
+def _observe(stats, name, value):
+    h, bounds = stats["hist"][name], HISTOGRAMS[name]
+    h["buckets"][next((i for i, b in enumerate(bounds) if value <= b), len(bounds))] += 1
+    h["sum"]   += value
+    h["count"] += 1
+
+
+def estimate_cost(model, prompt_tokens, response_tokens):
+    price_in, price_out = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * price_in + response_tokens * price_out) / 1e6
+
+
+def new_call_record():
+    """What call_ai fills in about one call; passed to record_call when it returns."""
+    return {"model": None, "cache_hit": False, "coalesced": False, "retries": 0,
+            "prompt_tokens": 0, "response_tokens": 0, "error": None}
+
+
+def record_call(label, seconds, rec):
+    with _telemetry["lock"]:
+        s = _label_stats(label)
+        s["calls"]      += 1
+        s["cache_hits"] += rec["cache_hit"]
+        s["coalesced"]  += rec["coalesced"]
+        s["retries"]    += rec["retries"]
+        if rec["error"]:
+            s["errors"][rec["error"]] = s["errors"].get(rec["error"], 0) + 1
+        _observe(s, "call_seconds", seconds)
+        if rec["prompt_tokens"] and not rec["cache_hit"] and not rec["coalesced"]:
+            cost = estimate_cost(rec["model"], rec["prompt_tokens"], rec["response_tokens"])
+            s["models"][rec["model"]] = s["models"].get(rec["model"], 0) + 1
+            s["prompt_tokens"]   += rec["prompt_tokens"]
+            s["response_tokens"] += rec["response_tokens"]
+            s["cost_usd"]        += cost
+            _observe(s, "prompt_tokens", rec["prompt_tokens"])
+            _observe(s, "response_tokens", rec["response_tokens"])
+            _observe(s, "cost_usd", cost)
+        flush = time.time() - _telemetry["flushed"] > TELEMETRY_FLUSH_SECONDS
+        if flush:
+            _telemetry["flushed"] = time.time()
+    if flush:
+        write_telemetry()
+
+
+def instrumented(label):
+    """Decorator: time the function as a task and label the call_ai calls it makes."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            outer, _call_label.name = getattr(_call_label, "name", None), label
+            started = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _call_label.name = outer
+                with _telemetry["lock"]:
+                    s = _label_stats(label)
+                    s["tasks"] += 1
+                    _observe(s, "task_seconds", time.time() - started)
+        return wrapper
+    return decorate
+
+
+def telemetry_snapshot():
+    """Deep copy of the per-label metrics, plus the other subsystems' counters."""
+    with _telemetry["lock"]:
+        labels = json.loads(json.dumps(_telemetry["labels"]))
+    return {"started": _telemetry["started"], "written": time.time(), "labels": labels}
+
+
+def _csv_rows(labels):
+    out = io.StringIO()
+    w = csv.writer(out)
+    w.writerow(["label", "calls", "tasks", "cache_hits", "coalesced", "retries", "errors",
+                "prompt_tokens", "response_tokens", "cost_usd", "mean_call_seconds",
+                "mean_task_seconds"])
+    for label, s in sorted(labels.items()):
+        call, task = s["hist"]["call_seconds"], s["hist"]["task_seconds"]
+        w.writerow([label, s["calls"], s["tasks"], s["cache_hits"], s["coalesced"], s["retries"],
+                    sum(s["errors"].values()), s["prompt_tokens"], s["response_tokens"],
+                    f"{s['cost_usd']:.6f}",
+                    f"{call['sum'] / call['count']:.3f}" if call["count"] else "",
+                    f"{task['sum'] / task['count']:.3f}" if task["count"] else ""])
+    return out.getvalue()
+
+
+def prometheus_text(labels):
+    """The metrics in Prometheus text exposition format (histograms are cumulative)."""
+    lines = []
+    for name, bounds in HISTOGRAMS.items():
+        metric = f"alc_{name}"
+        lines += [f"# TYPE {metric} histogram"]
+        for label, s in sorted(labels.items()):
+            h, running = s["hist"][name], 0
+            for le, n in zip([*map(str, bounds), "+Inf"], h["buckets"]):
+                running += n
+                lines.append(f'{metric}_bucket{{label="{label}",le="{le}"}} {running}')
+            lines.append(f'{metric}_sum{{label="{label}"}} {h["sum"]:.6f}')
+            lines.append(f'{metric}_count{{label="{label}"}} {h["count"]}')
+    for counter in ("calls", "tasks", "cache_hits", "coalesced", "retries",
+                    "prompt_tokens", "response_tokens"):
+        lines.append(f"# TYPE alc_{counter}_total counter")
+        for label, s in sorted(labels.items()):
+            lines.append(f'alc_{counter}_total{{label="{label}"}} {s[counter]}')
+    lines.append("# TYPE alc_errors_total counter")
+    for label, s in sorted(labels.items()):
+        for cls, n in sorted(s["errors"].items()):
+            lines.append(f'alc_errors_total{{label="{label}",class="{cls}"}} {n}')
+    return "\n".join(lines) + "\n"
+
+
+def write_telemetry(directory=None):
+    """Write telemetry.json, telemetry.csv and metrics.prom. Returns the directory."""
+    directory = directory or TELEMETRY_DIR
+    snap = telemetry_snapshot()
+    write_json_atomic(os.path.join(directory, "telemetry.json"), snap)
+    write_text_atomic(os.path.join(directory, "telemetry.csv"), _csv_rows(snap["labels"]))
+    write_text_atomic(os.path.join(directory, "metrics.prom"), prometheus_text(snap["labels"]))
+    return directory
+
+
 # ──────────────────────────────────────────────────────────────────────────────
 # AI — GEMINI WITH ERROR HANDLING  (FIXED)
 # ──────────────────────────────────────────────────────────────────────────────
@@ -307,6 +592,8 @@ GEMINI_MODEL_CANDIDATES = [
     "gemini-1.5-pro",
 ]
 
+MAX_OUTPUT_TOKENS = 2048       # bumped from 1400 for longer guides
+
 # System instruction used for all educational prompts
 _SYSTEM_INSTRUCTION = (
     "You are an expert educational AI assistant. "
@@ -315,77 +602,653 @@ _SYSTEM_INSTRUCTION = (
 )
 
 
-def _find_working_model_name():
-    """
-    Return the name of the first model from GEMINI_MODEL_CANDIDATES that
-    actually exists in the user's Gemini project.
+# ── LLM backends ─────────────────────────────────────────────────────────────
+# Everything below talks to the model through llm_backend(), so the Gemini
+# SDK can be swapped for another provider or for the offline FakeBackend
+# (see "FAKE LLM BACKEND") without touching call_ai. A backend provides:
+#   name                                   used in cache keys and telemetry
+#   ready()                                credentials present?
+#   list_models()                          set of usable model IDs (may raise)
+#   model(model_name, temperature, schema) object whose generate_content(
+#                                          prompt, stream=False) returns (or,
+#                                          streaming, yields) responses with
+#                                          .parts, .text and .usage_metadata
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")          # or "fake"
 
-    Uses genai.list_models() which is FREE (no generation quota used).
-    Caches the result in st.session_state so we only probe once per session.
-    """
-    # Return cached result if we already found one
-    cached = st.session_state.get("working_model")
-    if cached:
-        return cached
 
-    _ensure_configured()
+class GeminiBackend:
+    """Google Gemini via google-generativeai."""
+    name = "gemini"
 
-    # Build a set of model IDs the API key has access to
-    try:
+    def ready(self):
+        return bool(GEMINI_API_KEY)
+
+    def list_models(self):
+        _ensure_configured()
         available = set()
         for m in genai.list_models():
             # m.name looks like "models/gemini-2.0-flash"
-            short = m.name.replace("models/", "")
-            available.add(short)
-            available.add(m.name)       # keep full name too
-    except Exception as e:
-        # If list_models itself fails the API key is almost certainly wrong
-        return None
+            available.add(m.name.replace("models/", ""))
+            available.add(m.name)           # keep full name too
+        return available
+
+    def model(self, model_name, temperature, schema=None):
+        return get_model(model_name, temperature, schema)
+
+
+def llm_backend():
+    """The process-wide backend selected by LLM_BACKEND."""
+    backends = {"gemini": GeminiBackend, "fake": FakeBackend}
+    if LLM_BACKEND not in backends:
+        raise ValueError(f"Unknown LLM_BACKEND {LLM_BACKEND!r} (expected one of {sorted(backends)})")
+    return shared(f"llm_backend:{LLM_BACKEND}", backends[LLM_BACKEND])
+
+
+# ── Model discovery ──────────────────────────────────────────────────────────
+# The list_models() result is shared by every session in the process. It is
+# warmed in a background thread at startup, served while fresh, and once
+# older than MODEL_DISCOVERY_TTL it keeps being served while a background
+# refresh runs — so no user request pays for the discovery round-trip except
+# the very first one if warm-up hasn't finished yet. A failed refresh keeps
+# the last good answer. Models that report "not found" are skipped for
+# MODEL_FAILURE_COOLDOWN seconds.
+MODEL_DISCOVERY_TTL    = int(os.getenv("MODEL_DISCOVERY_TTL", "3600"))
+MODEL_FAILURE_COOLDOWN = 600
+
+_discovery = shared("model_discovery", lambda: {
+    "name":       None,                 # chosen model, or None
+    "models":     [],                   # every usable candidate, in preference order
+    "checked_at": 0.0,                  # last successful list_models()
+    "lock":       threading.Lock(),
+    "done":       None,                 # Event of the refresh in flight, if any
+    "failed":     {},                   # model -> time it reported "not found"
+    "refreshes":  0,
+})
+
+
+def _list_available_models():
+    """Model IDs the API key can use (short and "models/..." forms). Raises on failure."""
+    return llm_backend().list_models()
+
+
+def refresh_model_discovery():
+    """Re-run discovery now (blocking) and publish the result to every session."""
+    d = _discovery
+    try:
+        available = _list_available_models()
+    except Exception:
+        available = None                # keep the last good answer
+    now = time.time()
+    with d["lock"]:
+        if available is not None:
+            d["failed"] = {m: t for m, t in d["failed"].items()
+                           if now - t < MODEL_FAILURE_COOLDOWN}
+            d["models"] = [c for c in GEMINI_MODEL_CANDIDATES
+                           if (c in available or f"models/{c}" in available)
+                           and c not in d["failed"]]
+            d["name"] = d["models"][0] if d["models"] else None
+            d["checked_at"] = now
+        d["refreshes"] += 1
+        done, d["done"] = d["done"], None
+    if done:
+        done.set()
+
+
+def _start_discovery_refresh():
+    """Start a background refresh unless one is already running. Returns its Event."""
+    d = _discovery
+    with d["lock"]:
+        if d["done"] is not None:
+            return d["done"]
+        d["done"] = done = threading.Event()
+    threading.Thread(target=refresh_model_discovery, name="model-discovery",
+                     daemon=True).start()
+    return done
+
+
+def warm_model_discovery():
+    """Kick off discovery at startup so the first request finds it done."""
+    if llm_backend().ready() and _discovery["name"] is None and not _discovery["checked_at"]:
+        _start_discovery_refresh()
+
+
+def mark_model_failed(model_name):
+    """Stop using a model that reported "not found" and look for another one."""
+    d = _discovery
+    with d["lock"]:
+        d["failed"][model_name] = time.time()
+        d["models"] = [m for m in d["models"] if m != model_name]
+        if d["name"] == model_name:
+            d["name"], d["checked_at"] = None, 0.0
+    _start_discovery_refresh()
 
-    # Pick the first candidate that exists
-    for candidate in GEMINI_MODEL_CANDIDATES:
-        if candidate in available or f"models/{candidate}" in available:
-            st.session_state.working_model = candidate
-            return candidate
 
-    return None
+def _find_working_model_name():
+    """
+    Return the name of the first model from GEMINI_MODEL_CANDIDATES that
+    actually exists in the user's Gemini project.
+
+    Uses genai.list_models() which is FREE (no generation quota used).
+    The result is cached process-wide (see "Model discovery" above).
+    """
+    d = _discovery
+    if d["name"]:
+        if time.time() - d["checked_at"] > MODEL_DISCOVERY_TTL:
+            _start_discovery_refresh()  # stale-while-revalidate
+        return d["name"]
+    # Nothing known yet: wait for the warm-up (or a fresh attempt) to finish.
+    _start_discovery_refresh().wait(timeout=20)
+    return d["name"]
+
+
+# Flipped once if the SDK is too old; process-wide, so a rerun doesn't re-probe
+_sdk_support = shared("sdk_support", lambda: {"system_instruction": True,
+                                               "response_schema":    True})
+
+# ── Structured output schemas ────────────────────────────────────────────────
+# Generators that expect a JSON array name one of these; the model is then
+# asked for application/json constrained to the schema, so replies parse
+# without fence-stripping. Older SDKs fall back to the prompt's instructions.
+_STR = {"type": "string"}
+JSON_SCHEMAS = {
+    "flashcards": {"type": "array", "items": {
+        "type": "object",
+        "properties": {"front": _STR, "back": _STR},
+        "required": ["front", "back"]}},
+    "mc_questions": {"type": "array", "items": {
+        "type": "object",
+        "properties": {
+            "question":    _STR,
+            "options":     {"type": "object",
+                            "properties": {k: _STR for k in "ABCD"},
+                            "required": list("ABCD")},
+            "correct":     {"type": "string", "enum": list("ABCD")},
+            "explanation": _STR},
+        "required": ["question", "options", "correct", "explanation"]}},
+    "open_questions": {"type": "array", "items": {
+        "type": "object",
+        "properties": {"question": _STR, "type": _STR, "rubric_focus": _STR},
+        "required": ["question", "type", "rubric_focus"]}},
+}
 
 
-def _build_model(model_name, temperature=0.7):
+def _build_model(model_name, temperature=0.7, max_output_tokens=MAX_OUTPUT_TOKENS, schema=None):
     """
     Build a GenerativeModel. Gracefully handles older SDK versions that
-    don't support `system_instruction`.
+    don't support `system_instruction` or response schemas (each probed
+    once per process). `schema` is a key of JSON_SCHEMAS.
     """
     _ensure_configured()
+    config = genai.GenerationConfig(temperature=temperature,
+                                    max_output_tokens=max_output_tokens)
+    if schema and _sdk_support["response_schema"]:
+        try:
+            config = genai.GenerationConfig(temperature=temperature,
+                                            max_output_tokens=max_output_tokens,
+                                            response_mime_type="application/json",
+                                            response_schema=JSON_SCHEMAS[schema])
+        except TypeError:
+            _sdk_support["response_schema"] = False
+    if _sdk_support["system_instruction"]:
+        try:
+            # Modern SDK (google-generativeai >= 0.4.0)
+            return genai.GenerativeModel(
+                model_name=model_name,
+                system_instruction=_SYSTEM_INSTRUCTION,
+                generation_config=config,
+            )
+        except TypeError:
+            # Older SDK — system_instruction not supported, fall back
+            _sdk_support["system_instruction"] = False
+    return genai.GenerativeModel(model_name=model_name, generation_config=config)
+
+
+# ── Model handle pool ────────────────────────────────────────────────────────
+# GenerativeModel objects are immutable once built, so one handle per
+# (model, temperature, config) is shared by every session via
+# st.cache_resource. Chat traffic is many small calls; this keeps the
+# construction cost (and the SDK's client channel) out of each one.
+MODEL_POOL_SIZE  = 32
+model_pool_stats = shared("model_pool_stats", lambda: {"lookups": 0, "builds": 0})
+
+
+@st.cache_resource(max_entries=MODEL_POOL_SIZE, show_spinner=False)
+def _pooled_model(model_name, temperature, max_output_tokens, schema=None):
+    bump(model_pool_stats, "builds")
+    return _build_model(model_name, temperature, max_output_tokens, schema)
+
+
+def get_model(model_name, temperature=0.7, schema=None):
+    """Shared GenerativeModel handle for this model/temperature/config."""
+    bump(model_pool_stats, "lookups")
+    return _pooled_model(model_name, round(float(temperature), 3), MAX_OUTPUT_TOKENS, schema)
+
+
+def model_pool_summary():
+    s = model_pool_stats
+    return {**s, "hits": s["lookups"] - s["builds"],
+            "hit_rate": (s["lookups"] - s["builds"]) / s["lookups"] if s["lookups"] else 0.0}
+
+
+# ── Response cache ───────────────────────────────────────────────────────────
+# Identical prompt + model + temperature + generation config → same answer,
+# without spending quota or 5–20 s of latency. Two tiers, both process-wide
+# (shared by every browser session): an in-memory LRU and JSON files on disk
+# that survive restarts. Entries expire after RESPONSE_CACHE_TTL seconds.
+RESPONSE_CACHE_DIR     = os.getenv("RESPONSE_CACHE_DIR", os.path.join(CACHE_ROOT, "responses"))
+RESPONSE_CACHE_TTL     = int(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+RESPONSE_CACHE_ITEMS   = int(os.getenv("RESPONSE_CACHE_ITEMS", "256"))
+RESPONSE_CACHE_MAX_MB  = int(os.getenv("RESPONSE_CACHE_MAX_MB", "50"))
+
+response_cache_stats = shared("response_cache_stats", lambda: {
+    "memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "bypassed": 0})
+_response_memory = shared("response_memory", OrderedDict)     # key -> (created_at, text)
+_response_lock   = shared("response_lock", threading.Lock)
+_response_disk   = shared("response_disk", lambda: {"bytes": None})   # estimated size of the dir
+
+
+def response_cache_key(model_name, prompt, temperature, schema=None):
+    payload = json.dumps({
+        "backend":     LLM_BACKEND,
+        "model":       model_name,
+        "system":      _SYSTEM_INSTRUCTION,
+        "temperature": round(float(temperature), 3),
+        "config":      {"max_output_tokens": MAX_OUTPUT_TOKENS, "schema": schema},
+        "prompt":      prompt,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def response_cache_get(key):
+    """Cached response text for `key`, or None (missing or older than the TTL)."""
+    now = time.time()
+    with _response_lock:
+        hit = _response_memory.get(key)
+        if hit and now - hit[0] <= RESPONSE_CACHE_TTL:
+            _response_memory.move_to_end(key)
+            response_cache_stats["memory_hits"] += 1
+            return hit[1]
+        if hit:
+            del _response_memory[key]
+
+    path = os.path.join(RESPONSE_CACHE_DIR, f"{key}.json")
     try:
-        # Modern SDK (google-generativeai >= 0.4.0)
-        return genai.GenerativeModel(
-            model_name=model_name,
-            system_instruction=_SYSTEM_INSTRUCTION,
-            generation_config=genai.GenerationConfig(
-                temperature=temperature,
-                max_output_tokens=2048,       # bumped from 1400 for longer guides
-            ),
-        )
-    except TypeError:
-        # Older SDK — system_instruction not supported, fall back
-        return genai.GenerativeModel(
-            model_name=model_name,
-            generation_config=genai.GenerationConfig(
-                temperature=temperature,
-                max_output_tokens=2048,
-            ),
-        )
+        with open(path, encoding="utf-8") as fh:
+            entry = json.load(fh)
+        if now - entry["created_at"] > RESPONSE_CACHE_TTL:
+            os.remove(path)
+            raise OSError("expired")
+        os.utime(path)                  # bump LRU position
+    except (OSError, ValueError, KeyError):
+        with _response_lock:
+            response_cache_stats["misses"] += 1
+        return None
+    with _response_lock:
+        _remember_response(key, entry["created_at"], entry["text"])
+        response_cache_stats["disk_hits"] += 1
+    return entry["text"]
+
+
+def _remember_response(key, created_at, text):
+    """Insert into the memory tier (caller holds _response_lock)."""
+    _response_memory[key] = (created_at, text)
+    _response_memory.move_to_end(key)
+    while len(_response_memory) > RESPONSE_CACHE_ITEMS:
+        _response_memory.popitem(last=False)
+        response_cache_stats["evictions"] += 1
+
+
+def response_cache_put(key, text, model_name=""):
+    created = time.time()
+    with _response_lock:
+        _remember_response(key, created, text)
+        response_cache_stats["stores"] += 1
+    path = os.path.join(RESPONSE_CACHE_DIR, f"{key}.json")
+    if not write_json_atomic(path, {"created_at": created, "model": model_name, "text": text}):
+        return
+    # The directory is only listed when the running size estimate says it may
+    # be over the limit (or on the first write), not on every store; eviction
+    # then goes down to 90% so the next scan is a good number of writes away.
+    limit = RESPONSE_CACHE_MAX_MB * 1024 * 1024
+    with _response_lock:
+        disk = _response_disk
+        if disk["bytes"] is not None:
+            try:
+                disk["bytes"] += os.path.getsize(path)
+            except OSError:
+                pass
+        if disk["bytes"] is not None and disk["bytes"] <= limit:
+            return
+    evicted, left = evict_lru_files(RESPONSE_CACHE_DIR, int(limit * 0.9))
+    with _response_lock:
+        _response_disk["bytes"] = left
+        response_cache_stats["evictions"] += evicted
+
+
+# ── Rate limiting & retries ─────────────────────────────────────────────────
+# One process-wide limiter shared by every session: a requests-per-minute and
+# a tokens-per-minute token bucket per model. Callers queue in FIFO order
+# instead of failing, and see their queue position while they wait.
+# Transient errors (429/500/503) are retried with full-jitter exponential
+# backoff until CALL_DEADLINE_SECONDS after the call started.
+RATE_LIMIT_RPM        = int(os.getenv("RATE_LIMIT_RPM", "15"))
+RATE_LIMIT_TPM        = int(os.getenv("RATE_LIMIT_TPM", "1000000"))
+CALL_DEADLINE_SECONDS = int(os.getenv("CALL_DEADLINE_SECONDS", "90"))
+RETRY_BASE_DELAY      = 2.0
+RETRY_MAX_DELAY       = 30.0
+
+rate_limit_stats = shared("rate_limit_stats", lambda: {
+    "calls": 0, "waits": 0, "wait_seconds": 0.0, "retries": 0, "timeouts": 0})
+
+
+class RateLimiter:
+    """FIFO token-bucket limiter over requests and tokens per minute, per model."""
+
+    def __init__(self, rpm, tpm):
+        self.rpm, self.tpm = rpm, tpm
+        self.lock     = threading.Lock()
+        self._cond    = threading.Condition(self.lock)
+        self._buckets = {}              # model -> [requests, tokens, last_refill]
+        self._queues  = {}              # model -> [ticket, ...] waiting in order
+        self._tickets = 0
+
+    def _refill(self, model):
+        b = self._buckets.setdefault(model, [float(self.rpm), float(self.tpm), time.time()])
+        now = time.time()
+        elapsed, b[2] = now - b[2], now
+        b[0] = min(self.rpm, b[0] + elapsed * self.rpm / 60)
+        b[1] = min(self.tpm, b[1] + elapsed * self.tpm / 60)
+        return b
+
+    def acquire(self, model, tokens, deadline, on_wait=None):
+        """
+        Block until `model` has room for one request of `tokens` tokens.
+        Returns False if that cannot happen before `deadline` (epoch seconds).
+        `on_wait(position, seconds)` is called while queued (1 = next in line).
+        """
+        tokens = min(tokens, self.tpm)  # a huge prompt must still fit eventually
+        with self._cond:
+            self._tickets += 1
+            ticket, queue = self._tickets, self._queues.setdefault(model, [])
+            queue.append(ticket)
+            started = time.time()
+            rate_limit_stats["calls"] += 1
+            try:
+                while True:
+                    b = self._refill(model)
+                    if queue[0] == ticket and b[0] >= 1 and b[1] >= tokens:
+                        b[0] -= 1
+                        b[1] -= tokens
+                        return True
+                    need = max((1 - b[0]) * 60 / self.rpm, (tokens - b[1]) * 60 / self.tpm, 0)
+                    ahead = queue.index(ticket)
+                    wait  = need + ahead * 60 / self.rpm
+                    if time.time() + min(wait, 1.0) > deadline:
+                        rate_limit_stats["timeouts"] += 1
+                        return False
+                    if on_wait:
+                        self.lock.release()     # don't hold the lock while rendering
+                        try:
+                            on_wait(ahead + 1, wait)
+                        finally:
+                            self.lock.acquire()
+                    self._cond.wait(timeout=min(max(need, 0.05), 1.0))
+            finally:
+                queue.remove(ticket)
+                waited = time.time() - started
+                if waited > 0.05:
+                    rate_limit_stats["waits"] += 1
+                    rate_limit_stats["wait_seconds"] += waited
+                self._cond.notify_all()
+
+
+rate_limiter = shared("rate_limiter", lambda: RateLimiter(RATE_LIMIT_RPM, RATE_LIMIT_TPM))
+
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff: uniform in [0, min(cap, base · 2^attempt)]."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+# ── Single-flight ────────────────────────────────────────────────────────────
+# A double-click or a rerun can fire the same prompt again while the first call
+# is still running. Identical concurrent calls (same response-cache key) are
+# coalesced process-wide: the first becomes the leader, the others wait for
+# its result instead of spending quota on a second call. Uncached calls
+# (cache=False, meant to differ per click) are only coalesced within a session.
+single_flight_stats = shared("single_flight_stats", lambda: {"leaders": 0, "coalesced": 0,
+                                                             "fallbacks": 0})
+_inflight      = shared("inflight_calls", dict)     # key -> {"done": Event, "result": str}
+_inflight_lock = shared("inflight_lock", threading.Lock)
+
+
+def _join_flight(key):
+    """(flight, is_leader) for `key`; the leader must call _land_flight."""
+    with _inflight_lock:
+        flight = _inflight.get(key)
+        if flight:
+            single_flight_stats["coalesced"] += 1
+            return flight, False
+        flight = _inflight[key] = {"done": threading.Event(), "result": ""}
+        single_flight_stats["leaders"] += 1
+        return flight, True
+
+
+def _land_flight(key, flight, result):
+    with _inflight_lock:
+        _inflight.pop(key, None)
+    flight["result"] = result
+    flight["done"].set()
+
+
+def single_flight_summary():
+    s = single_flight_stats
+    calls = s["leaders"] + s["coalesced"]
+    return {**s, "coalesced_rate": s["coalesced"] / calls if calls else 0.0}
+
+
+# ── Model routing & hedging ──────────────────────────────────────────────────
+# Every usable candidate model keeps a rolling window of latencies and errors
+# per call type (calls are typed by temperature, or by their JSON schema,
+# unless call_ai is given an explicit ctype).
+# Each call goes to the healthy model with the lowest p50 for its type; a
+# small share of calls tries models without enough samples yet, so the
+# numbers stay current. With MODEL_HEDGING=on, a non-streamed call that runs
+# past the p95 of its model is also sent to the next-best model, and the
+# first good reply wins (the slower one is cancelled or ignored).
+# The response cache and single-flight keys keep using the discovered default
+# model, so routing does not fragment the cache.
+MODEL_ROUTING         = os.getenv("MODEL_ROUTING", "latency")       # or "fixed"
+MODEL_HEDGING         = os.getenv("MODEL_HEDGING", "off") == "on"
+HEDGE_PERCENTILE      = 95
+ROUTER_WINDOW         = 50          # recent calls remembered per model and call type
+ROUTER_MIN_SAMPLES    = 3
+ROUTER_MAX_ERROR_RATE = 0.5
+ROUTER_EXPLORE        = 0.1         # share of calls sent to an under-sampled model
+_CALL_TYPES           = {0.2: "grading", 0.4: "report", 0.5: "guide", 0.6: "chat"}
+
+router_stats = shared("router_stats", lambda: {"routed": 0, "explored": 0,
+                                               "hedged": 0, "hedge_wins": 0})
+_router      = shared("model_router", lambda: {"lock": threading.Lock(), "calls": {}})
+
+
+def call_type(temperature, schema=None, ctype=None):
+    return ctype or schema or _CALL_TYPES.get(round(float(temperature), 1), f"t{float(temperature):g}")
+
+
+def router_record(model, ctype, seconds, ok):
+    with _router["lock"]:
+        calls = _router["calls"].setdefault((model, ctype), [])
+        calls.append((seconds, ok))
+        del calls[:-ROUTER_WINDOW]
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def model_health(model, ctype):
+    """Rolling {n, p50, p95, error_rate} for one model and call type."""
+    with _router["lock"]:
+        calls = list(_router["calls"].get((model, ctype), ()))
+    ok = [s for s, good in calls if good]
+    return {"n":          len(calls),
+            "p50":        _percentile(ok, 50) if ok else None,
+            "p95":        _percentile(ok, 95) if ok else None,
+            "error_rate": 1 - len(ok) / len(calls) if calls else 0.0}
+
+
+def _healthy(stats):
+    return (stats["n"] >= ROUTER_MIN_SAMPLES and stats["p50"] is not None
+            and stats["error_rate"] <= ROUTER_MAX_ERROR_RATE)
+
+
+def ranked_models(ctype, default):
+    """Usable models for this call type, best first (healthy by p50, then the rest)."""
+    models = list(_discovery["models"]) or [default]
+    stats  = {m: model_health(m, ctype) for m in models}
+    healthy = sorted((m for m in models if _healthy(stats[m])), key=lambda m: stats[m]["p50"])
+    return healthy + [m for m in models if m not in healthy]
+
+
+def route_model(ctype, default):
+    """The model to send a call of type `ctype` to."""
+    models = list(_discovery["models"])
+    if MODEL_ROUTING != "latency" or len(models) < 2:
+        return default
+    bump(router_stats, "routed")
+    under = [m for m in models if model_health(m, ctype)["n"] < ROUTER_MIN_SAMPLES]
+    if under and random.random() < ROUTER_EXPLORE:
+        bump(router_stats, "explored")
+        return random.choice(under)
+    ranked = ranked_models(ctype, default)
+    if not _healthy(model_health(ranked[0], ctype)):
+        return default if default in under else (under or ranked)[0]
+    return ranked[0]
+
+
+def router_summary():
+    """{call type: {model: health}} for every model and call type seen so far."""
+    with _router["lock"]:
+        keys = list(_router["calls"])
+    out = {}
+    for model, ctype in keys:
+        out.setdefault(ctype, {})[model] = model_health(model, ctype)
+    return {"stats": dict(router_stats), "models": out}
+
+
+def _usage(response, model_name, prompt, text):
+    """{model, prompt_tokens, response_tokens} from usage_metadata (estimated if absent)."""
+    meta = getattr(response, "usage_metadata", None)
+    return {"model":           model_name,
+            "prompt_tokens":   getattr(meta, "prompt_token_count", 0) or estimate_tokens(prompt),
+            "response_tokens": (getattr(meta, "candidates_token_count", 0)
+                                or (estimate_tokens(text) if text else 0))}
+
+
+def _timed_generate(model_name, prompt, temperature, schema, ctype, on_text=None):
+    """
+    One generate_content call, timed and recorded for the router under `ctype`.
+    Returns (text, usage) — see _usage.
+    """
+    started = time.time()
+    try:
+        model = llm_backend().model(model_name, temperature, schema)
+        if on_text:
+            text, response = "", None
+            for piece in model.generate_content(prompt, stream=True):
+                response = piece            # the last chunk carries the usage totals
+                if piece.parts:
+                    text += piece.text
+                    on_text(text)
+        else:
+            response = model.generate_content(prompt)
+            text = response.text if response.parts else ""
+    except Exception:
+        router_record(model_name, ctype, time.time() - started, False)
+        raise
+    router_record(model_name, ctype, time.time() - started, True)
+    return text, _usage(response, model_name, prompt, text)
+
+
+def _hedge_pool():
+    return shared("hedge_pool", lambda: ThreadPoolExecutor(max_workers=8,
+                                                           thread_name_prefix="hedge"))
 
 
-def call_ai(prompt, temperature=0.7):
+def _hedged_generate(model_name, prompt, temperature, schema, ctype):
+    """
+    _timed_generate on `model_name`; if it outlasts that model's p95 for this
+    call type, the next-best model gets the same request and the first good
+    reply wins. Returns (text, usage) (raises if every attempt failed).
+    """
+    p95   = model_health(model_name, ctype)["p95"]
+    first = _hedge_pool().submit(_timed_generate, model_name, prompt, temperature, schema, ctype)
+    backup = next((m for m in ranked_models(ctype, model_name) if m != model_name), None)
+    if p95 is None or backup is None:
+        return first.result()
+    done, _ = wait_futures([first], timeout=p95)
+    if done or not rate_limiter.acquire(backup, estimate_tokens(prompt), time.time()):
+        return first.result()       # finished in time, or no free slot for a hedge
+
+    bump(router_stats, "hedged")
+    second  = _hedge_pool().submit(_timed_generate, backup, prompt, temperature, schema, ctype)
+    pending = {first, second}
+    error   = None
+    while pending:
+        done, pending = wait_futures(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            if fut.exception() is None:
+                for loser in pending:
+                    loser.cancel()      # already running: its reply is just ignored
+                bump(router_stats, "hedge_wins", fut is second)
+                return fut.result()
+            error = fut.exception()
+    raise error
+
+
+class _NoUI:
+    """Stands in for `st` in background threads, where there is no page to draw on."""
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+
+_NO_UI = _NoUI()
+
+
+def call_ai(prompt, temperature=0.7, cache=True, on_text=None, schema=None, accept=None,
+            ctype=None):
     """
     Central function: sends a prompt to Gemini and returns the text response.
     All other generate_* / grade_* / chat_* functions go through here.
+    Pass cache=False for creative calls that should produce something new
+    every time (e.g. a fresh set of practice questions).
+    Pass on_text to stream: it is called with the text so far each time a
+    chunk arrives (once, with the whole text, on a cache hit). The return
+    value is still the complete text.
+    Pass schema (a JSON_SCHEMAS key) to constrain the reply to that JSON shape.
+    Pass accept(text) → bool to keep unusable replies out of the cache: a
+    reply it rejects is not stored, and a cached one it rejects is a miss.
+    Pass ctype to file the call under that router call type instead of the
+    one its temperature / schema implies.
+    Outside a script run (background jobs) nothing is drawn on the page.
     """
+    rec     = new_call_record()
+    started = time.time()
+    try:
+        return _call_ai(prompt, temperature, cache, on_text, schema, rec, accept, ctype)
+    finally:
+        label = getattr(_call_label, "name", None) or call_type(temperature, schema, ctype)
+        record_call(label, time.time() - started, rec)
+
+
+def _call_ai(prompt, temperature, cache, on_text, schema, rec, accept=None, ctype=None):
+    ui = st if get_script_run_ctx(suppress_warning=True) else _NO_UI
+
     # ── Guard: no API key ────────────────────────────────────────────────────
-    if not GEMINI_API_KEY:
-        st.markdown("""<div class="q-error">
+    if not llm_backend().ready():
+        ui.markdown("""<div class="q-error">
         <div class="q-error-title">⚠️ No Gemini API Key</div>
         <div class="q-error-body">
         Create a <code>.env</code> file in the same folder as <code>app.py</code> and add:<br>
@@ -393,12 +1256,13 @@ def call_ai(prompt, temperature=0.7):
         Get a free key at
         <a href="https://aistudio.google.com/apikey" target="_blank">aistudio.google.com/apikey</a>
         </div></div>""", unsafe_allow_html=True)
+        rec["error"] = "no_api_key"
         return ""
 
     # ── Find a model ─────────────────────────────────────────────────────────
-    model_name = _find_working_model_name()
+    model_name = rec["model"] = _find_working_model_name()
     if model_name is None:
-        st.markdown("""<div class="q-error">
+        ui.markdown("""<div class="q-error">
         <div class="q-error-title">🔄 No Working Gemini Model Found</div>
         <div class="q-error-body">
         Could not find any available Gemini model. Please check:<br>
@@ -407,105 +1271,1277 @@ def call_ai(prompt, temperature=0.7):
         3. Your internet connection is working.<br><br>
         Then restart the app with <code>streamlit run app.py</code>
         </div></div>""", unsafe_allow_html=True)
+        rec["error"] = "no_model"
         return ""
 
-    # ── Call the model ───────────────────────────────────────────────────────
+    # ── Response cache ───────────────────────────────────────────────────────
+    key = response_cache_key(model_name, prompt, temperature, schema)
+    if cache:
+        cached = response_cache_get(key)
+        if cached is not None and (accept is None or accept(cached)):
+            rec["cache_hit"] = True
+            if on_text:
+                on_text(cached)
+            return cached
+    else:
+        with _response_lock:
+            response_cache_stats["bypassed"] += 1
+
+    # ── Single-flight: share an identical call already in progress ──────────
+    if cache:
+        flight_key = key
+    else:
+        ctx = get_script_run_ctx(suppress_warning=True)
+        flight_key = f"{key}:{ctx.session_id if ctx else threading.get_ident()}"
+    while True:
+        flight, leader = _join_flight(flight_key)
+        if leader:
+            break
+        flight["done"].wait(timeout=CALL_DEADLINE_SECONDS + 60)
+        if flight["result"]:
+            rec["coalesced"] = True
+            if on_text:
+                on_text(flight["result"])
+            return flight["result"]
+        with _inflight_lock:                    # the leader failed: try ourselves
+            single_flight_stats["fallbacks"] += 1
+    text = ""
     try:
-        model = _build_model(model_name, temperature)
-        response = model.generate_content(prompt)
+        text = _generate(model_name, key, prompt, temperature, cache, on_text, schema, ui, rec,
+                         accept, ctype)
+    finally:
+        _land_flight(flight_key, flight, text)
+    return text
 
-        # Some responses may be blocked by safety filters
-        if not response.parts:
-            st.warning("⚠️ The AI returned an empty response (possibly blocked by safety filters). Try rephrasing.")
+
+def _generate(model_name, key, prompt, temperature, cache, on_text, schema, ui, rec,
+              accept=None, ctype=None):
+    """
+    The actual model call behind call_ai: routed, rate-limited, transient
+    errors retried. `model_name` is the default model (the cache key's); if a
+    routed model fails for good, the call falls back to it once, quietly.
+    """
+    deadline = time.time() + CALL_DEADLINE_SECONDS
+    status   = ui.empty()
+    attempt  = 0
+    ctype    = call_type(temperature, schema, ctype)
+    pinned   = None                     # set once a routed model has failed
+    while True:
+        use = pinned or route_model(ctype, model_name)
+        def show_wait(position, seconds):
+            status.info(f"⏳ Waiting for a Gemini slot — position **{position}** in the "
+                        f"queue (~{max(1, round(seconds))}s).")
+        if not rate_limiter.acquire(use, estimate_tokens(prompt), deadline, show_wait):
+            status.empty()
+            rec["error"] = "queue_timeout"
+            _show_ai_error("429 client-side queue deadline exceeded", use, ui)
+            return ""
+        status.empty()
+        try:
+            if on_text or not MODEL_HEDGING:
+                text, usage = _timed_generate(use, prompt, temperature, schema, ctype, on_text)
+            else:
+                text, usage = _hedged_generate(use, prompt, temperature, schema, ctype)
+            rec.update(usage)
+
+            # Some responses may be blocked by safety filters
+            if not text:
+                rec["error"] = "empty"
+                ui.warning("⚠️ The AI returned an empty response (possibly blocked by safety filters). Try rephrasing.")
+                return ""
+
+            if cache and text and (accept is None or accept(text)):
+                response_cache_put(key, text, use)
+            return text
+
+        except Exception as e:
+            err   = str(e)
+            delay = backoff_delay(attempt)
+            if _is_transient_error(err) and time.time() + delay < deadline:
+                attempt += 1
+                rec["retries"] += 1
+                with rate_limiter.lock:
+                    rate_limit_stats["retries"] += 1
+                status.info(f"⏳ Gemini is busy — retrying in {delay:.0f}s (attempt {attempt + 1})...")
+                time.sleep(delay)
+                continue
+            if use != model_name and not pinned and not _is_transient_error(err):
+                # Only the routed model is at fault (already recorded by
+                # _timed_generate): stop routing to it and use the default
+                if error_class(err) in ("model_unavailable", "auth"):
+                    mark_model_failed(use)
+                pinned = model_name
+                rec["retries"] += 1
+                continue
+            status.empty()
+            rec["error"] = error_class(err)
+            _show_ai_error(err, use, ui)
             return ""
 
-        return response.text
 
-    except Exception as e:
-        err = str(e)
-
-        # ── Rate limit / quota ───────────────────────────────────────────────
-        if "429" in err or "quota" in err.lower() or "resource_exhausted" in err.lower():
-            st.markdown("""<div class="q-error">
-            <div class="q-error-title">⏱️ Rate Limit — Wait and Retry</div>
-            <div class="q-error-body">
-            You've hit the API rate limit. Wait <b>60 seconds</b>, then try again.<br>
-            <em>Tip: The free tier allows ~15 requests per minute.</em>
-            </div></div>""", unsafe_allow_html=True)
-
-        # ── Authentication ───────────────────────────────────────────────────
-        elif "401" in err or "403" in err or "api_key" in err.lower() or "permission" in err.lower():
-            st.markdown("""<div class="q-error">
-            <div class="q-error-title">🔑 API Key Problem</div>
-            <div class="q-error-body">
-            Your API key was rejected. Check that:<br>
-            1. The key in <code>.env</code> is correct (no extra spaces).<br>
-            2. The key hasn't been revoked in Google AI Studio.<br>
-            3. Billing/free-tier is active.
-            </div></div>""", unsafe_allow_html=True)
-
-        # ── Model not found (shouldn't happen after list_models check) ──────
-        elif "not found" in err.lower() or "not supported" in err.lower():
-            st.session_state.working_model = None       # reset so we re-probe
-            st.markdown(f"""<div class="q-error">
-            <div class="q-error-title">🔄 Model Unavailable</div>
-            <div class="q-error-body">
-            Model <code>{model_name}</code> returned an error. The app will
-            try a different model on the next request.
-            </div></div>""", unsafe_allow_html=True)
-
-        # ── Server errors ────────────────────────────────────────────────────
-        elif "503" in err or "500" in err or "unavailable" in err.lower():
-            st.error("⏳ Gemini servers are temporarily busy. Wait 30 seconds and try again.")
-
-        # ── Anything else ────────────────────────────────────────────────────
-        else:
-            st.session_state.working_model = None
-            st.error(f"Unexpected AI error: {err}")
+def _is_transient_error(err):
+    low = err.lower()
+    return ("429" in err or "500" in err or "503" in err or "resource_exhausted" in low
+            or "unavailable" in low or "deadline" in low)
+
+
+def error_class(err):
+    """Short class of a failed call's error, for telemetry (same buckets as _show_ai_error)."""
+    low = err.lower()
+    if "429" in err or "quota" in low or "resource_exhausted" in low:
+        return "rate_limit"
+    if "401" in err or "403" in err or "api_key" in low or "permission" in low:
+        return "auth"
+    if "not found" in low or "not supported" in low:
+        return "model_unavailable"
+    if "503" in err or "500" in err or "unavailable" in low:
+        return "server"
+    return "other"
+
+
+def _show_ai_error(err, model_name, ui=st):
+    """Render the right error box for a failed Gemini call."""
+    # ── Rate limit / quota ───────────────────────────────────────────────────
+    if "429" in err or "quota" in err.lower() or "resource_exhausted" in err.lower():
+        ui.markdown(f"""<div class="q-error">
+        <div class="q-error-title">⏱️ Rate Limit — Wait and Retry</div>
+        <div class="q-error-body">
+        The API is still rate-limited after waiting and retrying for
+        {CALL_DEADLINE_SECONDS} seconds. Wait a minute, then try again.<br>
+        <em>Tip: The free tier allows ~15 requests per minute.</em>
+        </div></div>""", unsafe_allow_html=True)
 
-        return ""
+    # ── Authentication ───────────────────────────────────────────────────────
+    elif "401" in err or "403" in err or "api_key" in err.lower() or "permission" in err.lower():
+        ui.markdown("""<div class="q-error">
+        <div class="q-error-title">🔑 API Key Problem</div>
+        <div class="q-error-body">
+        Your API key was rejected. Check that:<br>
+        1. The key in <code>.env</code> is correct (no extra spaces).<br>
+        2. The key hasn't been revoked in Google AI Studio.<br>
+        3. Billing/free-tier is active.
+        </div></div>""", unsafe_allow_html=True)
+
+    # ── Model not found (shouldn't happen after list_models check) ──────────
+    elif "not found" in err.lower() or "not supported" in err.lower():
+        mark_model_failed(model_name)               # re-probe, skipping this one
+        ui.markdown(f"""<div class="q-error">
+        <div class="q-error-title">🔄 Model Unavailable</div>
+        <div class="q-error-body">
+        Model <code>{model_name}</code> returned an error. The app will
+        try a different model on the next request.
+        </div></div>""", unsafe_allow_html=True)
+
+    # ── Server errors ────────────────────────────────────────────────────────
+    elif "503" in err or "500" in err or "unavailable" in err.lower():
+        ui.error("⏳ Gemini servers are still busy after several retries. Wait 30 seconds and try again.")
+
+    # ── Anything else ────────────────────────────────────────────────────────
+    else:
+        ui.error(f"Unexpected AI error: {err}")
+
+# ──────────────────────────────────────────────────────────────────────────────
+# FAKE LLM BACKEND  (LLM_BACKEND=fake)
+# ──────────────────────────────────────────────────────────────────────────────
+# A local stand-in for Gemini used by benchmark.py, load tests and offline
+# work. It recognises the app's own prompts and answers in the shape each
+# parser expects — markdown study guides, JSON arrays matching JSON_SCHEMAS,
+# "SCORE:" grades, batch-grading arrays, diagnostic reports — built from
+# words of the prompt's material. The same prompt always gets the same reply.
+# Latency is time-to-first-token plus a cost per output token, scaled per
+# model so the router has something to choose between. FAKE_ERROR_RATE makes
+# that share of calls fail with a transient error, drawn from a seeded RNG.
+FAKE_LATENCY_MS   = float(os.getenv("FAKE_LATENCY_MS", "300"))
+FAKE_MS_PER_TOKEN = float(os.getenv("FAKE_MS_PER_TOKEN", "1"))
+FAKE_ERROR_RATE   = float(os.getenv("FAKE_ERROR_RATE", "0"))
+FAKE_ERROR        = os.getenv("FAKE_ERROR", "503 UNAVAILABLE: simulated overload")
+FAKE_SEED         = int(os.getenv("FAKE_SEED", "0"))
+FAKE_MODEL_SPEED  = {"gemini-2.5-flash": 1.0, "gemini-2.0-flash": 0.8,
+                     "gemini-1.5-flash": 0.9, "gemini-1.5-pro": 1.5}
+
+_FAKE_MATERIAL_END = re.compile(
+    r"\n(?:ALREADY WRITTEN|Each |Respond ONLY|\nRules:|\nQUESTION:|\nITEM \d|"
+    r"\nPERFORMANCE:|\nCONVERSATION HISTORY:|\nTHE STUDENT)")
+_FAKE_SKIP_WORDS = {"material", "student", "question", "questions", "answer", "should",
+                    "course", "teacher", "summary", "explain", "explanation", "which",
+                    "about", "their", "there", "these", "those", "where", "would"}
+
+
+class _FakeUsage:
+    def __init__(self, prompt_tokens, response_tokens):
+        self.prompt_token_count     = prompt_tokens
+        self.candidates_token_count = response_tokens
+
+
+class _FakeResponse:
+    """The parts of a GenerateContentResponse that call_ai reads."""
+    def __init__(self, text, usage):
+        self.text           = text
+        self.parts          = [text] if text else []
+        self.usage_metadata = usage
+
+
+def _fake_material(prompt):
+    """The MATERIAL section of an app prompt (the whole prompt if there is none)."""
+    for label in ("COURSE MATERIAL:\n", "MATERIAL:\n"):
+        if label in prompt:
+            body = prompt.split(label, 1)[1]
+            end = _FAKE_MATERIAL_END.search(body)
+            return body[:end.start()] if end else body
+    return prompt
+
+
+def _fake_topics(material, limit=12):
+    """Most frequent content words of the material, most frequent first."""
+    counts = {}
+    for w in re.findall(r"[A-Za-z][A-Za-z\-]{4,}", material):
+        w = w.lower()
+        if w not in _FAKE_SKIP_WORDS:
+            counts[w] = counts.get(w, 0) + 1
+    ranked = sorted(counts, key=lambda w: (-counts[w], w))[:limit]
+    return ranked or ["the material"]
+
+
+def _fake_sentence(material, topic, rng):
+    """A sentence of the material mentioning `topic`, trimmed to 160 characters."""
+    found = [s.strip() for s in re.split(r"(?<=[.!?])\s+|\n+", material)
+             if topic in s.lower() and len(s.strip()) > 20]
+    text = rng.choice(found) if found else f"The material discusses {topic}."
+    return text if len(text) <= 160 else text[:157].rstrip() + "..."
+
+
+def _fake_json_items(kind, n, topics, material, rng):
+    items = []
+    for i in range(n):
+        topic = rng.choice(topics)
+        fact  = _fake_sentence(material, topic, rng)
+        tag   = f"{rng.randrange(1000):03d}"         # keeps top-up items distinct
+        if kind == "flashcards":
+            items.append({"front": f"What does the material say about {topic}? ({tag})",
+                          "back":  fact})
+        elif kind == "mc_questions":
+            correct = rng.choice("ABCD")
+            other   = rng.choice([t for t in topics if t != topic] or topics)
+            wrong   = iter([f"It is unrelated to {other}.", f"It only applies to {other}.",
+                            f"It is another name for {other}."])
+            options = {k: fact if k == correct else next(wrong) for k in "ABCD"}
+            items.append({"question":    f"Which statement about {topic} is correct? ({tag})",
+                          "options":     options, "correct": correct,
+                          "explanation": f"The material states: {fact}"})
+        else:
+            items.append({"question":     f"Explain the role of {topic} in the material. ({tag})",
+                          "type":         "Applied scenario" if i % 2 else "Conceptual",
+                          "rubric_focus": f"Defines {topic} and relates it to {rng.choice(topics)}"})
+    return json.dumps(items, indent=2)
+
+
+def _fake_grade(answer, rng):
+    """(score, strengths, weaknesses, revision) — longer answers score higher."""
+    words      = len(answer.split())
+    score      = max(0, min(10, 2 + words // 6 + rng.randint(-1, 1)))
+    strengths  = "Relevant points in the answer." if words > 5 else "An attempt was made."
+    weaknesses = "Could use more detail from the material." if score < 8 else "Minor gaps only."
+    return score, strengths, weaknesses, "Re-read the relevant section and add a concrete example."
+
+
+def fake_reply(prompt, schema=None):
+    """Deterministic reply to one of the app's prompts."""
+    rng      = random.Random(f"{FAKE_SEED}:{prompt}")
+    material = _fake_material(prompt)
+    topics   = _fake_topics(material)
+    head     = prompt.lstrip().split("\n", 1)[0]
+    m        = re.search(r"Generate exactly (\d+)", head)
+    n        = int(m.group(1)) if m else 5
+
+    kind = schema
+    if not kind and m:
+        kind = ("flashcards" if "flashcards" in head else
+                "mc_questions" if "multiple choice" in head else "open_questions")
+    if kind:
+        return _fake_json_items(kind, n, topics, material, rng)
+
+    if head.startswith("Grade each student answer"):
+        grades = []
+        for num, answer in re.findall(r"ITEM (\d+)\n.*?STUDENT ANSWER: (.*?)(?=\n\nITEM \d|\n\nGrade each)",
+                                      prompt, re.DOTALL):
+            score, strengths, weaknesses, revision = _fake_grade(answer, rng)
+            grades.append({"ITEM": int(num), "SCORE": score, "STRENGTHS": strengths,
+                           "WEAKNESSES": weaknesses, "REVISION": revision})
+        return json.dumps(grades, indent=2)
+
+    if head.startswith("Grade this student answer"):
+        am = re.search(r"STUDENT ANSWER: (.*?)\n\nGrade on", prompt, re.DOTALL)
+        score, strengths, weaknesses, revision = _fake_grade(am.group(1) if am else "", rng)
+        return (f"SCORE: {score}\nSTRENGTHS: {strengths}\n"
+                f"WEAKNESSES: {weaknesses}\nREVISION: {revision}")
+
+    if head.startswith("Create a study guide"):
+        picked = topics[:rng.randint(3, 5)]
+        parts  = [f"## Overview\n\nThis guide covers {', '.join(picked)}."]
+        for t in picked:
+            parts.append(f"## {t.capitalize()}\n\n"
+                         f"- {_fake_sentence(material, t, rng)}\n"
+                         f"- {_fake_sentence(material, t, rng)}")
+        parts.append("## Key Takeaways\n\n" + "\n".join(
+            f"- {t.capitalize()} is central to this material." for t in picked))
+        return "\n\n".join(parts)
+
+    if head.startswith("Write a diagnostic report"):
+        gap, strong = rng.choice(topics), rng.choice(topics)
+        return (f"## Performance Overview\n\nSolid grasp of the basics.\n\n"
+                f"## Knowledge Gaps\n\n- {gap}: {_fake_sentence(material, gap, rng)}\n\n"
+                f"## Strengths\n\n- {strong}\n\n"
+                f"## Recommended Actions\n\n- Review {gap} and practise one exercise on it.\n\n"
+                f"## Focus for Next Session\n\n- {gap}")
+
+    if head.startswith("Update the summary"):
+        return (f"The student asked about {', '.join(topics[:3])}; the teacher explained "
+                f"each with examples from the material.")
+
+    # Teacher and contextual chat
+    qm    = re.search(r"STUDENT'S QUESTION: (.*)", prompt)
+    focus = next((t for t in topics if qm and t in qm.group(1).lower()), topics[0])
+    return (f"Good question. In the course material, {focus} comes up here: "
+            f"{_fake_sentence(material, focus, rng)}\n\n"
+            f"In short, {focus} connects to {rng.choice(topics)}. "
+            f"Try restating it in your own words to check your understanding.")
+
+
+class FakeModel:
+    """Stand-in for a GenerativeModel handle (see FakeBackend)."""
+
+    def __init__(self, backend, model_name, schema=None):
+        self.backend    = backend
+        self.model_name = model_name
+        self.schema     = schema
+
+    def generate_content(self, prompt, stream=False):
+        text  = fake_reply(prompt, self.schema)
+        usage = _FakeUsage(estimate_tokens(prompt), estimate_tokens(text))
+        speed = FAKE_MODEL_SPEED.get(self.model_name, 1.0) / 1000
+        if stream:
+            return self._stream(text, usage, speed)
+        time.sleep(FAKE_LATENCY_MS * speed)
+        self.backend.maybe_fail()
+        time.sleep(usage.candidates_token_count * FAKE_MS_PER_TOKEN * speed)
+        return _FakeResponse(text, usage)
+
+    def _stream(self, text, usage, speed):
+        time.sleep(FAKE_LATENCY_MS * speed)
+        self.backend.maybe_fail()
+        words = text.split(" ")
+        for i in range(0, len(words), 20):
+            chunk = " ".join(words[i:i + 20]) + (" " if i + 20 < len(words) else "")
+            time.sleep(estimate_tokens(chunk) * FAKE_MS_PER_TOKEN * speed)
+            yield _FakeResponse(chunk, usage)
+
+
+class FakeBackend:
+    """Offline backend: every candidate model exists and answers from fake_reply()."""
+    name = "fake"
+
+    def __init__(self):
+        self.lock  = threading.Lock()
+        self.stats = {"calls": 0, "errors": 0}
+
+    def ready(self):
+        return True
+
+    def list_models(self):
+        return set(GEMINI_MODEL_CANDIDATES)
+
+    def model(self, model_name, temperature, schema=None):
+        return FakeModel(self, model_name, schema)
+
+    def maybe_fail(self):
+        """Raise the injected error for this call, if the seeded draw says so."""
+        with self.lock:
+            self.stats["calls"] += 1
+            n = self.stats["calls"]
+        if FAKE_ERROR_RATE and random.Random(f"{FAKE_SEED}:call:{n}").random() < FAKE_ERROR_RATE:
+            with self.lock:
+                self.stats["errors"] += 1
+            raise RuntimeError(FAKE_ERROR)
 
 
 # ──────────────────────────────────────────────────────────────────────────────
 # PDF PROCESSING
 # ──────────────────────────────────────────────────────────────────────────────
 
-def extract_single_pdf(f):
-    text = ""
+# ── Parallel extraction settings ─────────────────────────────────────────────
+# Large lecture packs (300–600 pages) are split into page ranges and handed to
+# a process pool. Small uploads stay serial — spinning up worker processes
+# costs more than it saves for a handful of pages.
+PDF_WORKERS            = int(os.getenv("PDF_WORKERS", min(4, os.cpu_count() or 1)))
+PDF_PAGES_PER_TASK     = 40
+PDF_PARALLEL_MIN_PAGES = 60
+
+
+def _extract_page_range(data, start, end):
+    """
+    Extract text from pages [start, end) of a PDF given as raw bytes.
+    Runs inside worker processes, so it only takes picklable arguments.
+    """
+    pages = []
+    with pdfplumber.open(io.BytesIO(data)) as pdf:
+        for page in pdf.pages[start:end]:
+            pages.append(page.extract_text() or "")
+    return pages
+
+
+def _count_pages(data):
+    with pdfplumber.open(io.BytesIO(data)) as pdf:
+        return len(pdf.pages)
+
+
+# ── Extracted-text cache ─────────────────────────────────────────────────────
+# Content-addressed: the key is the SHA-256 of the uploaded bytes, so the same
+# syllabus re-uploaded in another session or course skips pdfplumber entirely.
+# One JSON file per document; the file mtime doubles as the LRU timestamp.
+PDF_CACHE_DIR       = os.getenv("PDF_CACHE_DIR", os.path.join(CACHE_ROOT, "pdf_text"))
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_MB", "200")) * 1024 * 1024
+
+pdf_cache_stats = shared("pdf_cache_stats", lambda: {"hits": 0, "misses": 0, "evictions": 0})
+
+
+def pdf_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _pdf_cache_path(digest):
+    return os.path.join(PDF_CACHE_DIR, f"{digest}.json")
+
+
+def pdf_cache_get(digest):
+    """Return the cached entry for `digest` (and mark it recently used), or None."""
+    path = _pdf_cache_path(digest)
     try:
-        with pdfplumber.open(f) as pdf:
-            for page in pdf.pages:
-                t = page.extract_text()
-                if t:
-                    text += t + "\n"
+        with open(path, encoding="utf-8") as fh:
+            entry = json.load(fh)
+        os.utime(path)                  # bump LRU position
+    except (OSError, ValueError):
+        return None
+    return entry
+
+
+def pdf_cache_put(digest, name, pages):
+    """Store per-page text plus metadata, then evict down to the size limit."""
+    entry = {
+        "digest":       digest,
+        "name":         name,
+        "page_count":   len(pages),
+        "word_count":   sum(len(p.split()) for p in pages),
+        "extracted_at": datetime.now().isoformat(timespec="seconds"),
+        "pages":        pages,
+    }
+    if not write_json_atomic(_pdf_cache_path(digest), entry):
+        return                          # cache is best-effort
+    bump(pdf_cache_stats, "evictions", evict_lru_files(PDF_CACHE_DIR, PDF_CACHE_MAX_BYTES)[0])
+
+
+# ── Streaming ingestion ──────────────────────────────────────────────────────
+# page → units → chunk. Pages are consumed one at a time and only the chunk
+# currently being filled is buffered, so a 600-page pack is never held as one
+# big string (and never re-split just to count words).
+
+def _iter_doc_pages_serial(name, data, start=0):
+    """Yield page texts of one document from page `start` onwards."""
+    try:
+        with pdfplumber.open(io.BytesIO(data)) as pdf:
+            for page in pdf.pages[start:]:
+                yield page.extract_text() or ""
     except Exception as e:
-        st.warning(f"Problem reading {f.name}: {e}")
-    return text.strip()
+        st.warning(f"Problem reading {name}: {e}")
 
 
-def process_multiple_pdfs(files):
-    combined, names = "", []
-    for f in files:
-        t = extract_single_pdf(f)
-        if t.strip():
-            combined += f"\n\n=== DOCUMENT: {f.name} ===\n\n{t}\n\n"
-            names.append(f.name)
-    if not combined.strip():
-        return [], [], 0
-    wc     = len(combined.split())
-    chunks = chunk_text(combined)
-    return chunks, names, wc
+def _submit_page_ranges(pool, data, count):
+    return [pool.submit(_extract_page_range, data, start,
+                        min(count, start + PDF_PAGES_PER_TASK))
+            for start in range(0, count, PDF_PAGES_PER_TASK)]
+
+
+def _iter_doc_pages_parallel(futures, name, data):
+    """
+    Yield one document's page texts in order as its page ranges complete.
+    If the pool breaks, the remaining pages are read serially.
+    """
+    done = 0
+    try:
+        for fut in futures:
+            for t in fut.result():
+                yield t
+                done += 1
+    except Exception:
+        # BrokenProcessPool, pickling problems on spawn-based platforms,
+        # or a worker crashing on a malformed page — finish serially.
+        for fut in futures:
+            fut.cancel()
+        yield from _iter_doc_pages_serial(name, data, done)
+
+
+def iter_pages(docs, workers=None, use_cache=True, on_page=None, digests=None):
+    """
+    Yield (doc_index, page_text) for a list of (name, bytes) documents, in
+    document and page order.
+
+    Cached documents are served from disk. The rest go through a process pool
+    when there are enough pages to make it worthwhile and `workers` > 1,
+    otherwise serially. Freshly extracted documents are written to the cache.
+    `on_page(done, total, name)` is called after every page for progress UI.
+    """
+    workers = PDF_WORKERS if workers is None else workers
+    digests = digests or [pdf_digest(data) for _, data in docs]
+    cached  = {}
+    for i, digest in enumerate(digests):
+        entry = pdf_cache_get(digest) if use_cache else None
+        if entry is not None:
+            cached[i] = entry["pages"]
+            bump(pdf_cache_stats, "hits")
+        else:
+            bump(pdf_cache_stats, "misses")
+
+    counts = page_counts(docs, cached)
+    total  = sum(counts)
+    done   = 0
+    pool   = None
+    ranges = {}                         # doc_index -> futures, all submitted up front
+    try:
+        if workers > 1 and sum(counts[i] for i in range(len(docs))
+                               if i not in cached) >= PDF_PARALLEL_MIN_PAGES:
+            try:
+                pool = ProcessPoolExecutor(max_workers=workers)
+                for i, (_, data) in enumerate(docs):
+                    if i not in cached and counts[i]:
+                        ranges[i] = _submit_page_ranges(pool, data, counts[i])
+            except Exception:
+                ranges = {}             # no pool available — serial mode
+
+        for i, (name, data) in enumerate(docs):
+            if i in cached:
+                for t in cached[i]:
+                    done += 1
+                    if on_page:
+                        on_page(done, max(total, done), name)
+                    yield i, t
+                continue
+            if i in ranges:
+                stream = _iter_doc_pages_parallel(ranges[i], name, data)
+            else:
+                stream = _iter_doc_pages_serial(name, data)
+            pages = []                  # kept per document for the cache entry
+            for t in stream:
+                pages.append(t)
+                done += 1
+                if on_page:
+                    on_page(done, max(total, done), name)
+                yield i, t
+            # Cache only complete reads: a reader that hit a bad page stops early,
+            # and a truncated entry would be served for this file from then on.
+            if use_cache and pages and len(pages) == counts[i]:
+                pdf_cache_put(digests[i], name, pages)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+def page_counts(docs, cached=None):
+    """Page count per document (0 if unreadable); cached entries are not reopened."""
+    cached = cached or {}
+    counts = []
+    for i, (_, data) in enumerate(docs):
+        if i in cached:
+            counts.append(len(cached[i]))
+            continue
+        try:
+            counts.append(_count_pages(data))
+        except Exception:
+            counts.append(0)
+    return counts
+
+
+# ── Structure-aware chunking ─────────────────────────────────────────────────
+# Pages are split into units — headings, runs of code lines, and sentences of
+# prose — and units are packed into chunks up to an estimated token budget.
+# A heading starts a new chunk, code blocks and sentences are never split
+# (unless a single unit is larger than the whole budget), chunks never cross
+# documents, and consecutive chunks share ~CHUNK_OVERLAP_TOKENS of sentences.
+
+CHUNK_TOKEN_BUDGET   = int(os.getenv("CHUNK_TOKENS", "1000"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "100"))
+CHUNK_MIN_FILL       = 0.25            # don't break at a heading below this fill
+
+_HEADING_RE  = re.compile(r"^(#{1,6}\s+\S.*|\d+(\.\d+)*[.)]?\s+[A-Z].*|[A-Z][A-Z0-9 ,:&/()\-]{3,})$")
+_CODE_RE     = re.compile(r"<-|%>%|\|>|[{};]\s*$|^\s{4,}\S|\w\([^()]*\)\s*$"
+                          r"|^\s*(library|function|def|for|if|while|return)\b")
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9(\"'])")
+
+
+class Chunk:
+    """
+    Where a chunk came from. Text lives in course["chunks"]; this record sits
+    at the same position in course["chunk_meta"].
+    Page numbers are 1-based; character offsets index the document's text
+    (its pages joined with newlines). `dupes` holds (text, Chunk) pairs for
+    near-duplicate chunks from other uploads that were folded into this one.
+    """
+    __slots__ = ("doc", "page_start", "page_end", "char_start", "char_end", "tokens", "dupes")
 
+    def __init__(self, doc, page_start, page_end, char_start, char_end, tokens):
+        self.doc        = doc
+        self.page_start = page_start
+        self.page_end   = page_end
+        self.char_start = char_start
+        self.char_end   = char_end
+        self.tokens     = tokens
+        self.dupes      = []
 
-def chunk_text(text, size=800):
-    words = text.split()
-    return [" ".join(words[i:i+size]) for i in range(0, len(words), size)]
+    def pages(self):
+        if self.page_start == self.page_end:
+            return f"p. {self.page_start}"
+        return f"pp. {self.page_start}–{self.page_end}"
 
+    def sources(self):
+        """(doc, pages) for this chunk and every duplicate folded into it."""
+        return [(self.doc, self.pages())] + [(m.doc, m.pages()) for _, m in self.dupes]
 
-def get_context(chunks, max_chunks=2):
-    ctx   = "\n\n---\n\n".join(chunks[:max_chunks])
-    words = ctx.split()
-    return " ".join(words[:1400]) if len(words) > 1400 else ctx
+    def __repr__(self):
+        return (f"Chunk(doc={self.doc!r}, {self.pages()}, "
+                f"chars {self.char_start}–{self.char_end}, ~{self.tokens} tokens)")
+
+
+def estimate_tokens(text):
+    """Rough Gemini token estimate: ~4 characters per token."""
+    return max(1, (len(text) + 3) // 4)
+
+
+def _is_heading(line):
+    return (len(line) <= 80 and len(line.split()) <= 10
+            and not line.endswith((".", ",", ";")) and bool(_HEADING_RE.match(line)))
+
+
+def split_units(text):
+    """
+    Split one page into (kind, start, end) units, kind being "heading",
+    "code" or "sentence". Offsets index `text`.
+    """
+    units, para, code = [], None, None      # para/code: [start, end] of the open run
+
+    def close_para():
+        nonlocal para
+        if para:
+            s, e = para
+            pos = s
+            for m in _SENTENCE_RE.finditer(text, s, e):
+                units.append(("sentence", pos, m.start()))
+                pos = m.end()
+            units.append(("sentence", pos, e))
+            para = None
+
+    def close_code():
+        nonlocal code
+        if code:
+            units.append(("code", code[0], code[1]))
+            code = None
+
+    offset = 0
+    for line in text.split("\n"):
+        start, end = offset, offset + len(line)
+        offset = end + 1
+        stripped = line.strip()
+        if not stripped:
+            close_para(); close_code()
+        elif _is_heading(stripped):
+            close_para(); close_code()
+            units.append(("heading", start, end))
+        elif _CODE_RE.search(line):
+            close_para()
+            code = [code[0], end] if code else [start, end]
+        else:
+            close_code()
+            para = [para[0], end] if para else [start, end]
+    close_para(); close_code()
+    return units
+
+
+def _split_oversized(piece, budget):
+    """Break a unit larger than the whole budget into word windows that fit."""
+    words, out, buf = piece.split(), [], []
+    for w in words:
+        if buf and estimate_tokens(" ".join(buf + [w])) > budget:
+            out.append(" ".join(buf))
+            buf = []
+        buf.append(w)
+    if buf:
+        out.append(" ".join(buf))
+    return out
+
+
+def iter_structured_chunks(pages, doc_names, doc_ids,
+                           budget=CHUNK_TOKEN_BUDGET, overlap=CHUNK_OVERLAP_TOKENS):
+    """
+    Consume a (doc_index, page_text) stream and yield (text, Chunk) pairs.
+    Only the units of the chunk being filled are held in memory. Each chunk's
+    text starts with a `=== DOCUMENT: name · p. N ===` line so the model (and
+    the student) can see where the material came from.
+    """
+    cur, cur_tokens = [], 0         # cur: [kind, text, page, char_start, char_end, tokens]
+    doc, page_no, doc_offset = None, 0, 0
+
+    def emit(keep_overlap):
+        nonlocal cur, cur_tokens
+        if not cur:
+            return None
+        body = ""
+        for n, (kind, text, *_rest) in enumerate(cur):
+            if n:
+                block = kind != "sentence" or cur[n - 1][0] != "sentence"
+                body += "\n" if block else " "
+            body += text
+        meta = Chunk(doc_ids[doc], cur[0][2], cur[-1][2], cur[0][3], cur[-1][4], 0)
+        text = f"=== DOCUMENT: {doc_names[doc]} · {meta.pages()} ===\n{body}"
+        meta.tokens = estimate_tokens(text)
+        tail, tail_tokens = [], 0
+        if keep_overlap:
+            for unit in reversed(cur[1:]):      # never carry the whole chunk over
+                if unit[0] != "sentence" or tail_tokens + unit[5] > overlap:
+                    break
+                tail.insert(0, unit)
+                tail_tokens += unit[5]
+        cur, cur_tokens = tail, tail_tokens
+        return text, meta
+
+    for i, page_text in pages:
+        if i != doc:
+            out = emit(False)
+            if out:
+                yield out
+            doc, page_no, doc_offset = i, 0, 0
+        page_no += 1
+        for kind, s, e in split_units(page_text):
+            raw = page_text[s:e]
+            if kind == "code":
+                pieces = [raw.strip("\n")]
+            else:
+                pieces = [" ".join(raw.split())]
+            if not pieces[0].strip():
+                continue
+            if kind == "heading" and cur_tokens >= budget * CHUNK_MIN_FILL:
+                out = emit(False)           # new section — no overlap across it
+                if out:
+                    yield out
+            if estimate_tokens(pieces[0]) > budget:
+                pieces = _split_oversized(pieces[0], budget)
+            for piece in pieces:
+                tokens = estimate_tokens(piece)
+                if cur and cur_tokens + tokens > budget:
+                    out = emit(True)
+                    if out:
+                        yield out
+                cur.append([kind, piece, page_no, doc_offset + s, doc_offset + e, tokens])
+                cur_tokens += tokens
+        doc_offset += len(page_text) + 1
+    out = emit(False)
+    if out:
+        yield out
+
+
+def extract_single_pdf(f):
+    return "\n".join(t for t in _iter_doc_pages_serial(f.name, f.getvalue()) if t).strip()
+
+
+def process_multiple_pdfs(files, workers=None, on_page=None):
+    """
+    Run the streaming pipeline over uploaded files; `on_page` is passed to
+    iter_pages for progress. Returns (chunks, chunk_meta, names, word_count).
+    """
+    docs    = [(f.name, f.getvalue()) for f in files]
+    digests = [pdf_digest(data) for _, data in docs]
+    used    = set()                     # docs that produced any text
+    wc      = 0
+
+    def counted(pages):
+        nonlocal wc
+        for i, t in pages:
+            n = len(t.split())
+            if n:
+                wc += n
+                used.add(i)
+            yield i, t
+
+    pages  = counted(iter_pages(docs, workers, on_page=on_page, digests=digests))
+    chunks, meta = [], []
+    for text, m in iter_structured_chunks(pages, [n for n, _ in docs],
+                                          [d[:12] for d in digests]):
+        chunks.append(text)
+        meta.append(m)
+    if not chunks:
+        return [], [], [], 0
+    names = [docs[i][0] for i in sorted(used)]
+    return chunks, meta, names, wc
+
+
+def chunk_text(text, budget=CHUNK_TOKEN_BUDGET, name="text"):
+    """Chunk a plain string with the same structure-aware rules as PDFs."""
+    return [t for t, _ in iter_structured_chunks([(0, text)], [name], [name], budget)]
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# RETRIEVAL
+# ──────────────────────────────────────────────────────────────────────────────
+#
+# Two engines rank course["chunks"] against a query; both indexes are built at
+# ingestion time and stored in the course next to the chunks:
+#   "bm25"  — lexical BM25 inverted index             (course["bm25"])
+#   "tfidf" — hashed TF-IDF vectors in a NumPy matrix  (course["tfidf"])
+#   "first" — no ranking, the original "first N chunks" behaviour
+# get_context() falls back to "first" when there is no query or no match.
+# ──────────────────────────────────────────────────────────────────────────────
+
+RETRIEVAL_ENGINES  = ("bm25", "tfidf", "first")
+RETRIEVAL_ENGINE   = os.getenv("RETRIEVAL_ENGINE", "bm25")
+BM25_K1 = 1.5
+BM25_B  = 0.75
+TFIDF_DIM          = 2 ** 12          # hashed feature space
+CONTEXT_TOKEN_BUDGET = 2 * CHUNK_TOKEN_BUDGET + 50   # two chunks + separators
+UNION_TOKEN_BUDGET   = 3 * CONTEXT_TOKEN_BUDGET      # shared context of a batched call
+
+# Words, plus runs of symbols so operators like %>% and <- stay searchable.
+_TOKEN_RE = re.compile(r"[a-z0-9_]+|[^\sa-z0-9_]{2,}")
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall(text.lower())
+
+
+def build_bm25_index(chunks):
+    """
+    Build a BM25 inverted index: {term: [[chunk_id, tf], ...]} plus the
+    per-chunk lengths. Plain lists/dicts, so it can live in session state
+    next to the chunks. IDF is derived from posting-list lengths at query
+    time, which keeps adding and removing documents incremental.
+    """
+    index = {"postings": {}, "doc_len": [], "total_len": 0}
+    bm25_add(index, chunks)
+    return index
+
+
+def bm25_add(index, chunks):
+    """Append chunks to the index; their ids continue after the existing ones."""
+    postings, doc_len = index["postings"], index["doc_len"]
+    for chunk in chunks:
+        cid, tf = len(doc_len), {}
+        for tok in tokenize(chunk):
+            tf[tok] = tf.get(tok, 0) + 1
+        doc_len.append(sum(tf.values()))
+        index["total_len"] += doc_len[-1]
+        for term, n in tf.items():
+            postings.setdefault(term, []).append([cid, n])
+
+
+def bm25_remove(index, remap):
+    """
+    Drop chunks from the index without re-tokenising anything.
+    `remap` maps every kept old chunk id to its new id; other ids are removed.
+    """
+    for term in list(index["postings"]):
+        kept = [[remap[cid], tf] for cid, tf in index["postings"][term] if cid in remap]
+        if kept:
+            index["postings"][term] = kept
+        else:
+            del index["postings"][term]
+    doc_len = [0] * len(remap)
+    for old, new in remap.items():
+        doc_len[new] = index["doc_len"][old]
+    index["doc_len"]   = doc_len
+    index["total_len"] = sum(doc_len)
+
+
+def bm25_search(index, query, k=2):
+    """Return the ids of the top-k chunks for `query`, best first."""
+    if not index or not index["doc_len"]:
+        return []
+    postings, doc_len = index["postings"], index["doc_len"]
+    n_docs = len(doc_len)
+    avgdl  = (index["total_len"] / n_docs) or 1.0
+    scores = {}
+    for term in set(tokenize(query)):
+        plist = postings.get(term)
+        if not plist:
+            continue
+        w = math.log(1 + (n_docs - len(plist) + 0.5) / (len(plist) + 0.5))
+        for cid, tf in plist:
+            norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * doc_len[cid] / avgdl)
+            scores[cid] = scores.get(cid, 0.0) + w * tf * (BM25_K1 + 1) / norm
+    return heapq.nlargest(k, scores, key=scores.get)
+
+
+def _hash_counts(texts, dim=TFIDF_DIM):
+    """Term counts per text, with terms hashed (CRC32) into `dim` buckets."""
+    counts = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for tok in tokenize(text):
+            counts[row, zlib.crc32(tok.encode()) % dim] += 1
+    return counts
+
+
+def _tfidf_rows(tf, idf):
+    """TF × IDF, L2-normalised so a dot product is cosine similarity."""
+    vecs  = tf * idf
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    return vecs / np.where(norms == 0, 1, norms)
+
+
+def build_tfidf_index(chunks, dim=TFIDF_DIM):
+    """
+    Hashed TF-IDF index. Keeps the sublinear TF rows (chunks × dim, float32)
+    and per-bucket document frequencies, so chunks can be added or removed
+    without re-tokenising; the weighted, normalised matrix is derived lazily.
+    """
+    index = {"tf":     np.zeros((0, dim), dtype=np.float32),
+             "df":     np.zeros(dim, dtype=np.int32),
+             "matrix": None}
+    tfidf_add(index, chunks)
+    return index
+
+
+def tfidf_add(index, chunks):
+    """Append chunks as new rows; ids continue after the existing ones."""
+    if not chunks:
+        return
+    tf = np.log1p(_hash_counts(chunks, index["tf"].shape[1]))
+    index["tf"]     = np.vstack([index["tf"], tf])
+    index["df"]    += np.count_nonzero(tf, axis=0).astype(np.int32)
+    index["matrix"] = None
+
+
+def tfidf_remove(index, remap):
+    """Drop every row whose id is not a key of `remap` (kept rows keep their order)."""
+    keep = sorted(remap)
+    gone = np.setdiff1d(np.arange(len(index["tf"])), keep)
+    index["df"]    -= np.count_nonzero(index["tf"][gone], axis=0).astype(np.int32)
+    index["tf"]     = index["tf"][keep]
+    index["matrix"] = None
+
+
+def _tfidf_matrix(index):
+    """The weighted, L2-normalised matrix and IDF vector, recomputed after edits."""
+    if index.get("matrix") is None:
+        n = len(index["tf"])
+        index["idf"]    = (np.log((1 + n) / (1 + index["df"])) + 1).astype(np.float32)
+        index["matrix"] = _tfidf_rows(index["tf"], index["idf"])
+    return index["matrix"], index["idf"]
+
+
+def tfidf_search_batch(index, queries, k=2):
+    """
+    Top-k chunk ids for many queries with one matrix multiply.
+    Returns one list per query, best first; chunks with zero similarity are dropped.
+    """
+    if not index or not len(index["tf"]) or not queries:
+        return [[] for _ in queries]
+    matrix, idf = _tfidf_matrix(index)
+    q      = _tfidf_rows(np.log1p(_hash_counts(queries, matrix.shape[1])), idf)
+    scores = q @ matrix.T                                   # (queries × chunks)
+    k      = min(k, scores.shape[1])
+    top    = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    out    = []
+    for row, ids in enumerate(top):
+        ids = ids[np.argsort(-scores[row, ids])]
+        out.append([int(i) for i in ids if scores[row, i] > 0])
+    return out
+
+
+def tfidf_search(index, query, k=2):
+    return tfidf_search_batch(index, [query], k)[0]
+
+
+_SEARCHERS = {"bm25": bm25_search, "tfidf": tfidf_search}
+_BUILDERS  = {"bm25": build_bm25_index, "tfidf": build_tfidf_index}
+_ADDERS    = {"bm25": bm25_add, "tfidf": tfidf_add}
+_REMOVERS  = {"bm25": bm25_remove, "tfidf": tfidf_remove}
+
+
+def course_index(course, engine="bm25"):
+    """The course's index for `engine`, built on demand for courses processed before it existed."""
+    if engine not in _BUILDERS:
+        return None
+    if course.get(engine) is None and course.get("chunks"):
+        course[engine] = _BUILDERS[engine](course["chunks"])
+    return course.get(engine)
+
+
+def _join_context(chunks, ids, max_chunks):
+    picked = [chunks[i] for i in ids] if ids else chunks[:max_chunks]
+    ctx    = "\n\n---\n\n".join(picked)
+    if estimate_tokens(ctx) > CONTEXT_TOKEN_BUDGET:
+        # Older courses may hold larger chunks — trim at a word boundary.
+        return ctx[:CONTEXT_TOKEN_BUDGET * 4].rsplit(None, 1)[0]
+    return ctx
+
+
+def get_context(chunks, max_chunks=2, query=None, index=None, engine="bm25"):
+    """
+    Join the chunks most relevant to `query` into one context string, capped
+    at CONTEXT_TOKEN_BUDGET estimated tokens. `index` must match `engine` ("bm25" or
+    "tfidf"). With engine "first", no query, no index or no matching terms
+    this is the original behaviour: the first `max_chunks`.
+    """
+    search = _SEARCHERS.get(engine)
+    ids    = search(index, query, max_chunks) if search and query and index else []
+    return _join_context(chunks, ids, max_chunks)
+
+
+def grading_query(question_dict, answer):
+    """Retrieval query for grading: the question, its rubric and the answer."""
+    return " ".join([question_dict.get("question", ""),
+                     question_dict.get("rubric_focus", ""), answer or ""])
+
+
+def course_context(course, query=None, max_chunks=2, engine=None):
+    """get_context() for a course, using its index for `engine` when a query is given."""
+    engine = engine or RETRIEVAL_ENGINE
+    return get_context(course.get("chunks", []), max_chunks, query,
+                       course_index(course, engine) if query else None, engine)
+
+
+def course_contexts(course, queries, max_chunks=2, engine=None):
+    """
+    Contexts for many queries at once. With the "tfidf" engine every query is
+    scored in a single matrix multiply; other engines rank them one by one.
+    """
+    engine = engine or RETRIEVAL_ENGINE
+    chunks = course.get("chunks", [])
+    if engine == "tfidf":
+        ids = tfidf_search_batch(course_index(course, engine), list(queries), max_chunks)
+        return [_join_context(chunks, i, max_chunks) for i in ids]
+    return [course_context(course, q, max_chunks, engine) for q in queries]
+
+
+def course_context_union(course, queries, max_chunks=2, engine=None):
+    """
+    One context for a prompt that covers several queries (batch grading): every
+    query's top chunks, ranked by reciprocal-rank fusion (a chunk several
+    queries rank highly comes first), taken while they fit UNION_TOKEN_BUDGET
+    and joined once each in course order. The budget does not grow with the
+    number of queries — the material is sent once for all of them.
+    """
+    engine  = engine or RETRIEVAL_ENGINE
+    chunks  = course.get("chunks", [])
+    queries = list(queries)
+    index   = course_index(course, engine)
+    if engine == "tfidf":
+        ranked = tfidf_search_batch(index, queries, max_chunks)
+    else:
+        search = _SEARCHERS.get(engine)
+        ranked = [search(index, q, max_chunks) if search and q and index else []
+                  for q in queries]
+    fused = {}
+    for ids in ranked:
+        for rank, cid in enumerate(ids):
+            fused[cid] = fused.get(cid, 0.0) + 1 / (rank + 1)
+    order = (sorted(fused, key=lambda cid: (-fused[cid], cid))
+             or range(min(max_chunks, len(chunks))))
+    picked, used = [], 0
+    for cid in order:
+        cost = estimate_tokens(chunks[cid]) + 5             # + separator
+        if picked and used + cost > UNION_TOKEN_BUDGET:
+            continue
+        picked.append(cid)
+        used += cost
+    ctx = "\n\n---\n\n".join(chunks[i] for i in sorted(picked))
+    if estimate_tokens(ctx) > UNION_TOKEN_BUDGET:
+        return ctx[:UNION_TOKEN_BUDGET * 4].rsplit(None, 1)[0]
+    return ctx
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# COURSE KNOWLEDGE BASE
+# ──────────────────────────────────────────────────────────────────────────────
+#
+# A course's documents live in parallel lists: file_names / doc_ids per
+# document, chunks / chunk_meta per chunk. Adding files extracts and chunks
+# only the new ones and appends them to the indexes; removing a document
+# filters its chunks out of the lists and indexes — no rebuild either way.
+# The retrieval indexes and the LSH index below share chunk ids (positions).
+# ──────────────────────────────────────────────────────────────────────────────
+
+# ── Near-duplicate folding ───────────────────────────────────────────────────
+# Slides and handouts for the same lecture produce near-identical chunks.
+# Each chunk gets a MinHash signature over word 5-gram shingles; LSH banding
+# (16 bands × 4 rows) turns "find similar chunks" into a few bucket lookups,
+# so cost per new chunk stays flat as the course grows. Candidates are
+# confirmed by signature agreement ≥ DEDUP_THRESHOLD (≈ Jaccard similarity).
+
+DEDUP_THRESHOLD = 0.8
+MINHASH_PERM    = 64
+LSH_BANDS       = 16
+_LSH_ROWS       = MINHASH_PERM // LSH_BANDS
+_MINHASH_PRIME  = (1 << 31) - 1
+_rng            = np.random.default_rng(1)          # fixed: signatures must be stable
+_MINHASH_A      = _rng.integers(1, _MINHASH_PRIME, MINHASH_PERM, dtype=np.int64)
+_MINHASH_B      = _rng.integers(0, _MINHASH_PRIME, MINHASH_PERM, dtype=np.int64)
+
+
+def minhash(text, shingle=5):
+    """MinHash signature of a chunk body (the DOCUMENT header line is ignored) or other text."""
+    if text.startswith("=== DOCUMENT:"):
+        text = text.split("\n", 1)[-1]
+    toks = tokenize(text)
+    grams = {" ".join(toks[i:i+shingle]) for i in range(max(1, len(toks) - shingle + 1))}
+    h = np.fromiter((zlib.crc32(g.encode()) for g in grams), dtype=np.int64, count=len(grams))
+    h %= _MINHASH_PRIME
+    return ((_MINHASH_A[:, None] * h[None, :] + _MINHASH_B[:, None]) % _MINHASH_PRIME).min(axis=1)
+
+
+def _lsh_keys(sig):
+    return [(b, sig[b*_LSH_ROWS:(b+1)*_LSH_ROWS].tobytes()) for b in range(LSH_BANDS)]
+
+
+def lsh_add(lsh, sig, cid):
+    lsh["sigs"][cid] = sig
+    for key in _lsh_keys(sig):
+        lsh["buckets"].setdefault(key, []).append(cid)
+
+
+def lsh_remove(lsh, remap):
+    """Keep only ids in `remap`, renumbered — same contract as bm25_remove."""
+    lsh["sigs"] = {remap[c]: s for c, s in lsh["sigs"].items() if c in remap}
+    for key in list(lsh["buckets"]):
+        kept = [remap[c] for c in lsh["buckets"][key] if c in remap]
+        if kept:
+            lsh["buckets"][key] = kept
+        else:
+            del lsh["buckets"][key]
+
+
+def lsh_find(lsh, sig):
+    """Id of the most similar indexed chunk at or above DEDUP_THRESHOLD, else None."""
+    candidates = set()
+    for key in _lsh_keys(sig):
+        candidates.update(lsh["buckets"].get(key, ()))
+    best, best_sim = None, DEDUP_THRESHOLD
+    for cid in candidates:
+        sim = float(np.mean(lsh["sigs"][cid] == sig))
+        if sim >= best_sim:
+            best, best_sim = cid, sim
+    return best
+
+
+def course_lsh(course):
+    """The course's LSH index, built on demand for courses processed before it existed."""
+    if course.get("lsh") is None:
+        lsh = {"sigs": {}, "buckets": {}}
+        for cid, text in enumerate(course.get("chunks", [])):
+            lsh_add(lsh, minhash(text), cid)
+        course["lsh"] = lsh
+    return course["lsh"]
+
+
+def _append_chunks(course, chunks, meta):
+    """Append chunks to the course lists and every index (building missing ones)."""
+    for engine, add in _ADDERS.items():
+        if course.get(engine) is not None:
+            add(course[engine], chunks)
+        else:
+            course[engine] = _BUILDERS[engine](course.get("chunks", []) + chunks)
+    course["chunks"]     = course.get("chunks", []) + chunks
+    course["chunk_meta"] = course.get("chunk_meta", []) + meta
+
+
+def add_documents(course, files, workers=None, on_page=None):
+    """
+    Add uploaded files to the course. Files already in it (same bytes) are
+    skipped; near-duplicate chunks are folded into the existing chunk they
+    match. Returns (added_names, skipped_names, word_count, folded_chunks).
+    """
+    existing = set(course.get("doc_ids", []))
+    new, skipped = [], []
+    for f in files:
+        doc_id = pdf_digest(f.getvalue())[:12]
+        if doc_id in existing:
+            skipped.append(f.name)
+        else:
+            existing.add(doc_id)
+            new.append(f)
+    if not new:
+        return [], skipped, 0, 0
+
+    chunks, meta, names, wc = process_multiple_pdfs(new, workers, on_page)
+    if not chunks:
+        return [], skipped, 0, 0
+
+    lsh, base = course_lsh(course), len(course.get("chunks", []))
+    kept, kept_meta, folded = [], [], 0
+    for text, m in zip(chunks, meta):
+        sig = minhash(text)
+        dup = lsh_find(lsh, sig)
+        if dup is None:
+            lsh_add(lsh, sig, base + len(kept))
+            kept.append(text)
+            kept_meta.append(m)
+            continue
+        canonical = (course["chunk_meta"][dup] if dup < base else kept_meta[dup - base])
+        canonical.dupes.append((text, m))
+        folded += 1
+        stats = course.setdefault("dedup_stats", {"chunks": 0, "tokens": 0})
+        stats["chunks"] += 1
+        stats["tokens"] += m.tokens
+
+    _append_chunks(course, kept, kept_meta)
+    course["file_names"] = course.get("file_names", []) + names
+    course["doc_ids"]    = course.get("doc_ids", []) + list(dict.fromkeys(m.doc for m in meta))
+    return names, skipped, wc, folded
+
+
+def remove_document(course, doc_id):
+    """
+    Remove one document's chunks from the course and its indexes. If a
+    removed chunk had duplicates from other documents folded into it, the
+    first of those takes its place. Returns True on success.
+    """
+    chunks, meta = course.get("chunks", []), course.get("chunk_meta", [])
+    if doc_id not in course.get("doc_ids", []) or len(meta) != len(chunks):
+        return False
+    remap, kept_chunks, kept_meta, promoted = {}, [], [], []
+    for old, (c, m) in enumerate(zip(chunks, meta)):
+        dropped = [d for d in m.dupes if d[1].doc == doc_id]
+        if dropped:
+            m.dupes = [d for d in m.dupes if d[1].doc != doc_id]
+            stats = course.get("dedup_stats") or {"chunks": 0, "tokens": 0}
+            stats["chunks"] -= len(dropped)
+            stats["tokens"] -= sum(d[1].tokens for d in dropped)
+        if m.doc != doc_id:
+            remap[old] = len(kept_chunks)
+            kept_chunks.append(c)
+            kept_meta.append(m)
+        elif m.dupes:
+            (text, heir), rest = m.dupes[0], m.dupes[1:]
+            heir.dupes = rest
+            promoted.append((text, heir))
+            stats = course["dedup_stats"]
+            stats["chunks"] -= 1
+            stats["tokens"] -= heir.tokens
+
+    lsh = course_lsh(course)
+    lsh_remove(lsh, remap)
+    for engine, remove in _REMOVERS.items():
+        if course.get(engine) is not None:
+            if kept_chunks:
+                remove(course[engine], remap)
+            else:
+                course[engine] = None
+    course["chunks"], course["chunk_meta"] = kept_chunks, kept_meta
+    for text, heir in promoted:
+        lsh_add(lsh, minhash(text), len(course["chunks"]))
+        _append_chunks(course, [text], [heir])
+
+    if course.get("question_bank"):
+        bank_drop_document(course["question_bank"], doc_id)
+
+    i = course["doc_ids"].index(doc_id)
+    course["doc_ids"]    = course["doc_ids"][:i] + course["doc_ids"][i+1:]
+    course["file_names"] = course["file_names"][:i] + course["file_names"][i+1:]
+    return True
 
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -526,7 +2562,8 @@ TIMER_DURATIONS = {"Easy": 8, "Medium": 5, "Hard": 3}   # minutes per question
 # CONTENT GENERATION
 # ──────────────────────────────────────────────────────────────────────────────
 
-def generate_study_guide(context, tone, depth, fmt):
+@instrumented("study_guide")
+def generate_study_guide(context, tone, depth, fmt, on_text=None):
     prompt = f"""Create a study guide from this material ONLY.
 
 PREFERENCES — Tone: {tone} | Depth: {depth} | Format: {fmt}
@@ -541,18 +2578,109 @@ Rules:
 - End with "## Key Takeaways" listing 3-5 main ideas.
 
 Write now:"""
-    return call_ai(prompt, 0.5)
+    return call_ai(prompt, 0.5, on_text=on_text)
+
+
+# ── Structured JSON items ────────────────────────────────────────────────────
+# Generators ask for a JSON array (schema-constrained where the SDK allows,
+# see JSON_SCHEMAS). Replies are read object by object, so one malformed or
+# truncated item no longer throws away the rest; if fewer than `count` valid
+# items survive, a follow-up call asks for just the missing number.
+JSON_TOPUP_RETRIES = 2
+json_item_stats    = shared("json_item_stats", lambda: {"calls": 0, "topups": 0,
+                                                        "kept": 0, "dropped": 0})
 
 
-def generate_flashcards(context, study_guide):
-    prompt = f"""Generate exactly 8 flashcards from this study guide and material.
+def iter_json_objects(raw):
+    """
+    Yield every top-level {...} object in `raw` that parses on its own.
+    Tolerates code fences, prose around the array, malformed items (skipped)
+    and a reply cut off mid-item (everything before the cut is kept).
+    """
+    text  = raw or ""
+    depth = 0
+    start = None
+    in_str = escaped = False
+    for i, ch in enumerate(text):
+        if in_str:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = depth > 0
+        elif ch == "{":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif ch == "}" and depth:
+            depth -= 1
+            if depth == 0:
+                try:
+                    obj = json.loads(text[start:i + 1])
+                except ValueError:
+                    continue
+                if isinstance(obj, dict):
+                    yield obj
+
+
+def _avoid_block(stems):
+    """Prompt section listing items already kept, so a top-up doesn't repeat them."""
+    if not stems:
+        return ""
+    listed = "\n".join(f"- {s}" for s in stems)
+    return f"\nALREADY WRITTEN (do not repeat or rephrase these):\n{listed}\n"
+
+
+def generate_json_items(make_prompt, count, validate, stem, temperature,
+                        cache=True, schema=None):
+    """
+    Collect up to `count` valid items.
+    make_prompt(n, avoid) → prompt asking for n items, avoiding the stems in `avoid`.
+    validate(obj) → cleaned item, or None to drop it.
+    stem(item)    → text used to drop duplicates.
+    """
+    items, seen = [], set()
+    for attempt in range(1 + JSON_TOPUP_RETRIES):
+        missing = count - len(items)
+        if missing <= 0:
+            break
+        raw = call_ai(make_prompt(missing, [stem(i) for i in items]),
+                      temperature, cache=cache, schema=schema)
+        bump(json_item_stats, "calls")
+        bump(json_item_stats, "topups", attempt > 0)
+        if not raw:
+            break                       # the call itself failed; error already shown
+        for obj in iter_json_objects(raw):
+            item = validate(obj)
+            key  = " ".join(stem(item).lower().split()) if item else ""
+            if not key or key in seen or len(items) >= count:
+                bump(json_item_stats, "dropped")
+                continue
+            seen.add(key)
+            items.append(item)
+            bump(json_item_stats, "kept")
+    return items
+
+
+def _valid_flashcard(c):
+    front, back = str(c.get("front", "")).strip(), str(c.get("back", "")).strip()
+    return {"front": front, "back": back} if front and back else None
+
+
+@instrumented("flashcards")
+def generate_flashcards(context, study_guide, count=8):
+    def make_prompt(n, avoid):
+        return f"""Generate exactly {n} flashcards from this study guide and material.
 
 STUDY GUIDE:
 {study_guide[:800]}
 
 MATERIAL:
 {context}
-
+{_avoid_block(avoid)}
 Each flashcard must have a FRONT (concept/question, max 15 words) and a BACK (clear explanation, max 40 words).
 
 Respond ONLY with valid JSON — no markdown, no code fences, no extra text.
@@ -561,29 +2689,43 @@ Format exactly like this:
   {{"front": "question or concept here", "back": "explanation here"}},
   {{"front": "...", "back": "..."}}
 ]"""
-    raw = call_ai(prompt, 0.4)
-    if not raw:
-        return []
-    try:
-        clean = re.sub(r"```(?:json)?|```", "", raw).strip()
-        cards = json.loads(clean)
-        if isinstance(cards, list):
-            return [c for c in cards if "front" in c and "back" in c]
-    except Exception:
-        pass
-    return []
+    return generate_json_items(make_prompt, count, _valid_flashcard,
+                               lambda c: c["front"], 0.4, schema="flashcards")
 
 
+def _valid_mc_question(q):
+    """Keep well-formed questions (4 options, known answer) and shuffle their options."""
+    opts = q.get("options")
+    if not (q.get("question") and isinstance(opts, dict) and len(opts) == 4
+            and q.get("correct") in opts):
+        return None
+    items = list(opts.items())
+    random.shuffle(items)
+    # Remap correct answer to new position
+    old_correct_text = opts[q["correct"]]
+    new_opts = {}
+    new_correct = q["correct"]
+    for new_letter, (old_letter, text) in zip(["A","B","C","D"], items):
+        new_opts[new_letter] = text
+        if text == old_correct_text:
+            new_correct = new_letter
+    q["options"]  = new_opts
+    q["correct"]  = new_correct
+    return q
+
+
+@instrumented("mc_questions")
 def generate_mc_questions(context, difficulty, count=5):
     """Generate multiple choice questions. Returns list of dicts."""
     diff_desc = DIFFICULTY_DESCRIPTIONS.get(difficulty, DIFFICULTY_DESCRIPTIONS["Medium"])
-    prompt = f"""Generate exactly {count} multiple choice questions from this material ONLY.
+    def make_prompt(n, avoid):
+        return f"""Generate exactly {n} multiple choice questions from this material ONLY.
 
 DIFFICULTY: {difficulty} — focus on {diff_desc}
 
 MATERIAL:
 {context}
-
+{_avoid_block(avoid)}
 Each question must have exactly 4 options (A, B, C, D) and one correct answer.
 For Hard difficulty, make distractors subtle and plausible.
 
@@ -596,37 +2738,13 @@ Respond ONLY with valid JSON — no markdown, no code fences:
     "explanation": "brief explanation of why A is correct"
   }}
 ]"""
-    raw = call_ai(prompt, 0.5)
-    if not raw:
-        return []
-    try:
-        clean = re.sub(r"```(?:json)?|```", "", raw).strip()
-        qs = json.loads(clean)
-        if isinstance(qs, list):
-            # Shuffle options for each question
-            result = []
-            for q in qs:
-                if "question" in q and "options" in q and "correct" in q:
-                    items  = list(q["options"].items())
-                    random.shuffle(items)
-                    # Remap correct answer to new position
-                    old_correct_text = q["options"].get(q["correct"], "")
-                    new_opts = {}
-                    new_correct = q["correct"]
-                    for new_letter, (old_letter, text) in zip(
-                            ["A","B","C","D"], items):
-                        new_opts[new_letter] = text
-                        if text == old_correct_text:
-                            new_correct = new_letter
-                    q["options"]  = new_opts
-                    q["correct"]  = new_correct
-                    result.append(q)
-            return result
-    except Exception:
-        pass
-    return []
+    # cache=False: every click should give a new set
+    return generate_json_items(make_prompt, count, _valid_mc_question,
+                               lambda q: q["question"], 0.5, cache=False,
+                               schema="mc_questions")
 
 
+@instrumented("open_questions")
 def generate_open_questions(context, difficulty, count=5, is_test=False):
     """Generate open-ended questions. Returns list of dicts."""
     diff_desc = DIFFICULTY_DESCRIPTIONS.get(difficulty, DIFFICULTY_DESCRIPTIONS["Medium"])
@@ -639,16 +2757,20 @@ Question 5: Integrative (connect 2+ ideas)"""
         structure = """Questions 1-4: Conceptual
 Questions 5+: Applied scenario"""
 
-    prompt = f"""Generate exactly {count} open-ended questions from this material ONLY.
+    def make_prompt(n, avoid):
+        # A top-up fills the tail of the set, so it follows the end of the structure
+        plan = structure if n == count else (
+            f"These are questions {count - n + 1}-{count} of {count}:\n{structure}")
+        return f"""Generate exactly {n} open-ended questions from this material ONLY.
 
 DIFFICULTY: {difficulty} — {diff_desc}
 
 STRUCTURE:
-{structure}
+{plan}
 
 MATERIAL:
 {context}
-
+{_avoid_block(avoid)}
 Respond ONLY with valid JSON:
 [
   {{
@@ -657,17 +2779,11 @@ Respond ONLY with valid JSON:
     "rubric_focus": "what a good answer should address"
   }}
 ]"""
-    raw = call_ai(prompt, 0.5)
-    if not raw:
-        return []
-    try:
-        clean = re.sub(r"```(?:json)?|```", "", raw).strip()
-        qs = json.loads(clean)
-        if isinstance(qs, list):
-            return [q for q in qs if "question" in q]
-    except Exception:
-        pass
-    return []
+    # cache=False: every click should give a new set
+    return generate_json_items(make_prompt, count,
+                               lambda q: q if q.get("question") else None,
+                               lambda q: q["question"], 0.5, cache=False,
+                               schema="open_questions")
 
 
 def grade_mc(question_dict, student_answer):
@@ -685,6 +2801,7 @@ def grade_mc(question_dict, student_answer):
     }
 
 
+@instrumented("grade_open")
 def grade_open(context, question_dict, answer):
     """Rubric-style grading for open-ended answers."""
     if not answer or not answer.strip():
@@ -714,6 +2831,8 @@ STRENGTHS: [what the student got right]
 WEAKNESSES: [what was missing or wrong]
 REVISION: [specific advice for improvement]"""
     raw = call_ai(prompt, 0.2)
+    if not raw:
+        return grading_failure(question_dict, answer, "No response from the AI.")
     score, strengths, weaknesses, revision = 0, "", "", ""
     if raw:
         sm = re.search(r"SCORE:\s*(\d+)", raw)
@@ -734,6 +2853,148 @@ REVISION: [specific advice for improvement]"""
     }
 
 
+def grading_failure(question_dict, answer, reason):
+    """Placeholder grade for a question that could not be graded."""
+    return {
+        "score":     0,
+        "strengths": "",
+        "weaknesses": "",
+        "revision":  "",
+        "question":  question_dict.get("question", ""),
+        "answer":    answer,
+        "error":     reason,
+    }
+
+
+# ── Concurrent grading ───────────────────────────────────────────────────────
+# Open-ended answers are independent, so all grade_open calls are dispatched
+# at once through a thread pool capped at GRADING_CONCURRENCY (keep it under
+# the API's requests-per-minute limit). Worker threads get the Streamlit
+# script context so call_ai can still read session state and show errors.
+GRADING_CONCURRENCY = int(os.getenv("GRADING_CONCURRENCY", "4"))
+
+
+def grade_open_concurrent(items, max_workers=None, on_result=None):
+    """
+    Grade [(context, question_dict, answer), ...] concurrently.
+    Returns grades in the same order as `items`; a question whose grading
+    raised gets a grading_failure() entry instead of sinking the batch.
+    `on_result(done, total)` is called from the calling thread as each
+    grade arrives.
+    """
+    results = [None] * len(items)
+    if not items:
+        return results
+    ctx     = get_script_run_ctx()
+    workers = max(1, min(max_workers or GRADING_CONCURRENCY, len(items)))
+    with ThreadPoolExecutor(max_workers=workers,
+                            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+                            ) as pool:
+        futures = {pool.submit(grade_open, *item): i for i, item in enumerate(items)}
+        for done, fut in enumerate(as_completed(futures), 1):
+            i = futures[fut]
+            try:
+                results[i] = fut.result()
+            except Exception as e:
+                _, q, answer = items[i]
+                results[i] = grading_failure(q, answer, f"Grading failed: {e}")
+            if on_result:
+                on_result(done, len(items))
+    return results
+
+
+# ── Batched grading ──────────────────────────────────────────────────────────
+# Alternative to one prompt per answer: every open-ended answer goes into a
+# single call that returns a JSON array, so the course MATERIAL is sent once
+# instead of N times (≈N-fold fewer prompt tokens, one request against the
+# RPM limit). Items missing from a malformed reply are re-asked on their own.
+GRADING_MODE          = os.getenv("GRADING_MODE", "concurrent")   # or "batch"
+BATCH_GRADING_RETRIES = 2
+
+
+def _batch_grading_prompt(context, items):
+    blocks = "\n\n".join(
+        f"ITEM {n}\nQUESTION: {q.get('question', '')}\n"
+        f"RUBRIC FOCUS: {q.get('rubric_focus', '')}\nSTUDENT ANSWER: {a}"
+        for n, q, a in items)
+    return f"""Grade each student answer below using the course material and its rubric.
+
+MATERIAL:
+{context}
+
+{blocks}
+
+Grade each item on a scale 0-10 and provide structured feedback.
+
+Respond ONLY with valid JSON — no markdown, no code fences — one object per item:
+[
+  {{"ITEM": 1, "SCORE": 7, "STRENGTHS": "what the student got right",
+    "WEAKNESSES": "what was missing or wrong", "REVISION": "specific advice for improvement"}}
+]"""
+
+
+def parse_batch_grades(raw, expected):
+    """
+    Parse a batch-grading reply into {item_number: {score, strengths, weaknesses, revision}}.
+    Objects that are malformed, duplicated or not in `expected` are dropped.
+    """
+    out = {}
+    for obj in iter_json_objects(raw):
+        obj = {str(k).upper(): v for k, v in obj.items()}
+        try:
+            n     = int(obj.get("ITEM", obj.get("ID")))
+            score = min(10, max(0, int(round(float(obj["SCORE"])))))
+        except (TypeError, ValueError, KeyError):
+            continue
+        if n not in expected or n in out:
+            continue
+        out[n] = {
+            "score":      score,
+            "strengths":  str(obj.get("STRENGTHS", "")).strip(),
+            "weaknesses": str(obj.get("WEAKNESSES", "")).strip(),
+            "revision":   str(obj.get("REVISION", "")).strip(),
+        }
+    return out
+
+
+@instrumented("grade_open_batch")
+def grade_open_batch(context, items, on_result=None):
+    """
+    Grade [(question_dict, answer), ...] in one structured call, re-asking
+    only for items missing from the reply (up to BATCH_GRADING_RETRIES times).
+    Blank answers are graded locally. Returns grades in `items` order.
+    """
+    results = [None] * len(items)
+    pending = {}
+    for i, (q, answer) in enumerate(items):
+        if not answer or not answer.strip():
+            results[i] = grade_open(context, q, answer)     # local, no AI call
+        else:
+            pending[i + 1] = (q, answer)                    # 1-based ITEM numbers
+
+    for attempt in range(1 + BATCH_GRADING_RETRIES):
+        if not pending:
+            break
+        prompt = _batch_grading_prompt(
+            context, [(n, q, a) for n, (q, a) in sorted(pending.items())])
+        # A retry can repeat the same prompt (nothing parsed), so it must
+        # bypass the cache; replies that grade nothing are never cached.
+        want   = set(pending)
+        raw    = call_ai(prompt, 0.2, cache=attempt == 0,
+                         accept=lambda r: bool(parse_batch_grades(r, want)))
+        parsed = parse_batch_grades(raw, want)
+        for n, fields in parsed.items():
+            q, answer = pending.pop(n)
+            results[n - 1] = dict(fields, question=q.get("question", ""), answer=answer)
+        if on_result:
+            on_result(sum(r is not None for r in results), len(items))
+
+    for n, (q, answer) in pending.items():
+        results[n - 1] = grading_failure(q, answer, "Missing from the AI's batch reply.")
+    return results
+
+
+@instrumented("diagnostic")
 def generate_diagnostic(context, grades, q_type):
     summary = ""
     for i, g in enumerate(grades, 1):
@@ -767,12 +3028,88 @@ Be specific. Reference actual concepts. No generic advice."""
     return call_ai(prompt, 0.4)
 
 
-def chat_with_teacher(context, messages):
+# ── Conversation memory ──────────────────────────────────────────────────────
+# Chat prompts carry the last CHAT_RECENT_TURNS exchanges verbatim; older
+# turns are folded, CHAT_SUMMARY_BATCH messages at a time, into a running
+# summary kept in the chat's memory dict. The whole history section is held
+# to CHAT_HISTORY_TOKENS, so prompt size stays flat over a long session.
+CHAT_RECENT_TURNS   = int(os.getenv("CHAT_RECENT_TURNS", "3"))
+CHAT_HISTORY_TOKENS = int(os.getenv("CHAT_HISTORY_TOKENS", "1500"))
+CHAT_SUMMARY_BATCH  = 4
+chat_memory_stats   = shared("chat_memory_stats", lambda: {
+    "prompts": 0, "summaries": 0, "full_tokens": 0, "sent_tokens": 0})
+
+
+def new_chat_memory():
+    return {"summary": "", "covered": 0, "saved": 0}   # covered = messages summarised
+
+
+def _format_turns(messages):
+    return [f"{'Student' if m['role']=='user' else 'Teacher'}: {m['content']}"
+            for m in messages]
+
+
+@instrumented("chat_summary")
+def _summarise_turns(summary, messages):
+    """Fold `messages` into the running `summary` with one small AI call."""
+    turns = "\n".join(_format_turns(messages))
+    prompt = f"""Update the summary of a tutoring conversation with the new turns below.
+
+CURRENT SUMMARY:
+{summary or "(none yet)"}
+
+NEW TURNS:
+{turns}
+
+Write the updated summary in at most 120 words: the topics asked about, what the
+teacher explained, and anything the student struggled with. Plain text only."""
+    return call_ai(prompt, 0.2, ctype="chat").strip()   # routed with the chat calls
+
+
+def chat_history(messages, memory=None):
+    """
+    History section for a chat prompt (`messages` = earlier turns, without the
+    latest question): the running summary plus the most recent turns, within
+    CHAT_HISTORY_TOKENS. Updates `memory` and the token-savings counters.
+    """
+    if memory is None:
+        memory = new_chat_memory()
+    if memory["covered"] > len(messages):          # chat was cleared or edited
+        memory.update(new_chat_memory())
+    keep_from = max(0, len(messages) - 2 * CHAT_RECENT_TURNS)
+    if keep_from - memory["covered"] >= CHAT_SUMMARY_BATCH:
+        summary = _summarise_turns(memory["summary"], messages[memory["covered"]:keep_from])
+        if summary:                                 # on failure the turns stay verbatim
+            memory["summary"], memory["covered"] = summary, keep_from
+            bump(chat_memory_stats, "summaries")
+
+    head  = f"(Summary of the earlier conversation: {memory['summary']})" if memory["summary"] else ""
+    lines = _format_turns(messages[memory["covered"]:])
+    room  = CHAT_HISTORY_TOKENS - (estimate_tokens(head) if head else 0)
+    while len(lines) > 1 and sum(estimate_tokens(l) for l in lines) > room:
+        lines.pop(0)
+    if lines and estimate_tokens(lines[0]) > room:
+        lines[0] = lines[0][:max(0, room) * 4] + " …"
+    history = "\n".join(([head] if head else []) + lines)
+
+    full = sum(estimate_tokens(l) for l in _format_turns(messages)) if messages else 0
+    sent = estimate_tokens(history) if history else 0
+    bump(chat_memory_stats, "prompts")
+    bump(chat_memory_stats, "full_tokens", full)
+    bump(chat_memory_stats, "sent_tokens", sent)
+    memory["saved"] += max(0, full - sent)
+    return history
+
+
+def chat_memory_summary():
+    s = chat_memory_stats
+    return {**s, "saved_tokens": max(0, s["full_tokens"] - s["sent_tokens"])}
+
+
+@instrumented("teacher_chat")
+def chat_with_teacher(context, messages, on_text=None, cache=True, memory=None):
     """General teacher chat grounded in course material."""
-    history = "\n".join([
-        f"{'Student' if m['role']=='user' else 'Teacher'}: {m['content']}"
-        for m in messages[:-1]
-    ])
+    history = chat_history(messages[:-1], memory)
     latest = messages[-1]["content"] if messages else ""
     prompt = f"""You are an AI teacher. Answer the student's question based ONLY on the course material.
 Be clear, encouraging, and use examples from the material.
@@ -786,15 +3123,13 @@ CONVERSATION HISTORY:
 STUDENT'S QUESTION: {latest}
 
 Give a clear, helpful answer grounded in the material:"""
-    return call_ai(prompt, 0.6)
+    return call_ai(prompt, 0.6, cache=cache, on_text=on_text)
 
 
-def contextual_chat(context, highlighted_text, messages):
+@instrumented("contextual_chat")
+def contextual_chat(context, highlighted_text, messages, on_text=None, memory=None):
     """Chat about a specific piece of highlighted text."""
-    history = "\n".join([
-        f"{'Student' if m['role']=='user' else 'Teacher'}: {m['content']}"
-        for m in messages[:-1]
-    ])
+    history = chat_history(messages[:-1], memory)
     latest = messages[-1]["content"] if messages else ""
     prompt = f"""You are an AI teacher explaining a specific concept to a student.
 
@@ -810,7 +3145,374 @@ CONVERSATION HISTORY:
 STUDENT'S QUESTION: {latest}
 
 Explain clearly, staying focused on the highlighted text and the course material:"""
-    return call_ai(prompt, 0.6)
+    return call_ai(prompt, 0.6, on_text=on_text)
+
+
+# ── Teacher answer cache ─────────────────────────────────────────────────────
+# Students of the same course keep asking the same things in different words
+# ("what does %>% do?" / "what's the %>% operator for?"). Answered questions
+# are kept per course — keyed by the course's documents, so every session
+# with the same files shares them — as hashed vectors of word unigrams,
+# bigrams and character trigrams. A new standalone question whose cosine
+# similarity to a cached one reaches ANSWER_CACHE_THRESHOLD reuses its answer.
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.85"))
+ANSWER_CACHE_SIZE      = 500            # answers kept per course
+ANSWER_VEC_DIM         = 2048
+_QUESTION_STOPWORDS = {"a", "an", "the", "what", "whats", "does", "do", "is", "are", "how",
+                       "why", "can", "could", "you", "me", "i", "to", "of", "in", "and",
+                       "or", "for", "with", "on", "by", "at", "please", "explain", "tell",
+                       "about", "mean", "means", "s"}
+_FOLLOW_UP_WORDS    = {"it", "its", "that", "this", "these", "those", "they", "them",
+                       "above", "previous", "again", "another", "more", "else"}
+
+answer_cache_stats = shared("answer_cache_stats", lambda: {
+    "lookups": 0, "hits": 0, "stores": 0, "follow_ups": 0, "forced_fresh": 0})
+_answer_caches     = shared("answer_caches", dict)      # fingerprint -> {"vecs", "entries"}
+_answer_lock       = shared("answer_lock", threading.Lock)
+
+
+def course_fingerprint(course):
+    """Identifies a course by its documents' content, not its (per-student) name."""
+    return hashlib.sha256("|".join(sorted(course.get("doc_ids", []))).encode()).hexdigest()[:16]
+
+
+def question_vector(text, dim=ANSWER_VEC_DIM):
+    """L2-normalised hashed n-gram vector of a question (question words ignored)."""
+    words = [w for w in tokenize(text)
+             if w not in _QUESTION_STOPWORDS and w.strip("()[]{}?!.,;:'\"")]
+    feats = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    feats += [f"#{w[i:i+3]}" for w in words if len(w) > 3 for i in range(len(w) - 2)]
+    vec = np.zeros(dim, dtype=np.float32)
+    for f in feats:
+        vec[zlib.crc32(f.encode()) % dim] += 1
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+def is_follow_up(messages):
+    """True if the latest question leans on earlier turns ("and what about that?")."""
+    if len(messages) < 2:
+        return False
+    words = tokenize(messages[-1]["content"])
+    return bool(_FOLLOW_UP_WORDS.intersection(words)) or len(words) < 3
+
+
+def answer_cache_lookup(course, question):
+    """(cached_question, answer, similarity) for the closest match above the threshold, else None."""
+    vec = question_vector(question)
+    with _answer_lock:
+        answer_cache_stats["lookups"] += 1
+        cache = _answer_caches.get(course_fingerprint(course))
+        if not cache or not cache["entries"] or not vec.any():
+            return None
+        sims = cache["vecs"] @ vec
+        best = int(np.argmax(sims))
+        if sims[best] < ANSWER_CACHE_THRESHOLD:
+            return None
+        answer_cache_stats["hits"] += 1
+        q, answer = cache["entries"][best]
+        return q, answer, float(sims[best])
+
+
+def answer_cache_store(course, question, answer):
+    """Remember an answer, replacing a near-identical cached question's (e.g. a forced refresh)."""
+    vec = question_vector(question)
+    if not vec.any() or not answer:
+        return
+    with _answer_lock:
+        cache = _answer_caches.setdefault(course_fingerprint(course), {
+            "vecs": np.zeros((0, ANSWER_VEC_DIM), dtype=np.float32), "entries": []})
+        if cache["entries"]:
+            sims = cache["vecs"] @ vec
+            best = int(np.argmax(sims))
+            if sims[best] >= ANSWER_CACHE_THRESHOLD:
+                cache["entries"][best] = (question, answer)
+                cache["vecs"][best] = vec
+                answer_cache_stats["stores"] += 1
+                return
+        cache["entries"] = (cache["entries"] + [(question, answer)])[-ANSWER_CACHE_SIZE:]
+        cache["vecs"]    = np.vstack([cache["vecs"], vec[None, :]])[-ANSWER_CACHE_SIZE:]
+        answer_cache_stats["stores"] += 1
+
+
+def answer_cache_summary():
+    s = answer_cache_stats
+    return {**s, "hit_rate": s["hits"] / s["lookups"] if s["lookups"] else 0.0}
+
+
+def teacher_answer(course, context, messages, fresh=False, on_text=None, memory=None):
+    """
+    chat_with_teacher, answered from the course's answer cache when a standalone
+    question matches a previous one. Returns (reply, similarity of the cached
+    question or None). The cache is shared across sessions, so the cached
+    question itself is never handed back for display.
+    """
+    question = messages[-1]["content"] if messages else ""
+    if is_follow_up(messages):
+        with _answer_lock:
+            answer_cache_stats["follow_ups"] += 1
+        return chat_with_teacher(context, messages, on_text=on_text, memory=memory), None
+    if fresh:
+        with _answer_lock:
+            answer_cache_stats["forced_fresh"] += 1
+    else:
+        hit = answer_cache_lookup(course, question)
+        if hit:
+            return hit[1], hit[2]
+    reply = chat_with_teacher(context, messages, on_text=on_text, cache=not fresh,
+                              memory=memory)
+    answer_cache_store(course, question, reply)
+    return reply, None
+
+
+# ── Speculative pre-generation ───────────────────────────────────────────────
+# After a study guide is written, students almost always open Flashcards and
+# then Exercises next. Both sets are started in the background right away so
+# the click finds them ready. A job only ever lands in the course when the
+# user asks for that result (or opens Flashcards with none yet) and its
+# settings still match; a replaced or cancelled job is dropped, so it can
+# never overwrite something newer.
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "2"))
+prefetch_stats   = shared("prefetch_stats", lambda: {"started": 0, "hits": 0, "waited": 0,
+                                                     "misses": 0, "discarded": 0})
+
+
+def _prefetch_pool():
+    return shared("prefetch_pool", lambda: ThreadPoolExecutor(
+        max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch"))
+
+
+def start_prefetch(course, kind, key, fn, *args, **kwargs):
+    """Run fn(*args, **kwargs) in the background as the `kind` result for settings `key`."""
+    cancel_prefetch(course, kind)
+    future = _prefetch_pool().submit(fn, *args, **kwargs)
+    course.setdefault("prefetch", {})[kind] = {"key": key, "future": future}
+    bump(prefetch_stats, "started")
+
+
+def cancel_prefetch(course, kind):
+    """Drop the `kind` job; a running one finishes but its result is thrown away."""
+    job = course.get("prefetch", {}).pop(kind, None)
+    if job:
+        job["future"].cancel()
+        bump(prefetch_stats, "discarded")
+
+
+def prefetch_ready(course, kind, key):
+    job = course.get("prefetch", {}).get(kind)
+    return bool(job and job["key"] == key and job["future"].done())
+
+
+def take_prefetch(course, kind, key):
+    """
+    Claim the `kind` result made for `key`, waiting for it if it's still
+    running (that's never slower than starting over). None on a miss.
+    """
+    job = course.get("prefetch", {}).get(kind)
+    if not job or job["key"] != key:
+        bump(prefetch_stats, "misses")
+        return None
+    course["prefetch"].pop(kind)
+    ready = job["future"].done()
+    try:
+        result = job["future"].result(timeout=CALL_DEADLINE_SECONDS)
+    except Exception:
+        result = None
+    if not result:
+        bump(prefetch_stats, "misses")
+        return None
+    bump(prefetch_stats, "hits" if ready else "waited")
+    return result
+
+
+def prefetch_summary():
+    s = prefetch_stats
+    asked = s["hits"] + s["waited"] + s["misses"]
+    return {**s, "hit_rate": (s["hits"] + s["waited"]) / asked if asked else 0.0}
+
+
+def exercise_settings(course):
+    """(question type, difficulty) last used for exercises, else the form defaults."""
+    return course.get("ex_q_type", "Multiple Choice"), course.get("ex_difficulty", "Easy")
+
+
+def generate_exercises(context, q_type, difficulty):
+    if q_type == "Multiple Choice":
+        return generate_mc_questions(context, difficulty, count=6)
+    return generate_open_questions(context, difficulty, count=6)
+
+
+def prefetch_after_guide(course):
+    """Start flashcards and default exercises for the course's new study guide."""
+    guide = course["study_guide"]
+    ctx   = course_context(course, query=guide)
+    start_prefetch(course, "flashcards", guide, generate_flashcards, ctx, guide)
+    start_prefetch(course, "exercises", exercise_settings(course),
+                   generate_exercises, ctx, *exercise_settings(course))
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# QUESTION BANK
+# ──────────────────────────────────────────────────────────────────────────────
+#
+# Instead of one AI call per "Generate" click, a course can build a bank of
+# questions in bulk: BANK_ITEMS_PER_CHUNK per chunk × difficulty × type, with
+# the chunk itself as the material. Near-identical stems are dropped with the
+# same MinHash/LSH machinery used for chunks (on word pairs, since stems are
+# short). Exercise and test sets are then drawn instantly from the
+# (type, difficulty) index, spread across chunks, unseen items first.
+# One build makes at most BANK_BUILD_LIMIT calls (for the type and difficulty
+# currently selected, unless the student picks more), so a large course is
+# filled in steps instead of blocking the session for the whole pack.
+# ──────────────────────────────────────────────────────────────────────────────
+
+BANK_ITEMS_PER_CHUNK = 3
+BANK_CONCURRENCY     = int(os.getenv("BANK_CONCURRENCY", "4"))
+BANK_BUILD_LIMIT     = int(os.getenv("BANK_BUILD_LIMIT", "12"))     # AI calls per build
+BANK_TYPES           = ["Multiple Choice", "Open-ended"]
+BANK_DIFFICULTIES    = ["Easy", "Medium", "Hard"]
+
+
+def empty_bank():
+    return {
+        "items":   [],              # {id, type, difficulty, doc, page, question}
+        "index":   {},              # "type|difficulty" -> [positions in items]
+        "lsh":     {"sigs": {}, "buckets": {}},     # stems, keyed by item id
+        "done":    set(),           # (doc, char_start, type, difficulty) generated
+        "seen":    set(),           # ids already shown to the student
+        "next_id": 0,
+        "dupes":   0,               # stems dropped as near-duplicates
+    }
+
+
+def _bank_key(q_type, difficulty):
+    return f"{q_type}|{difficulty}"
+
+
+def bank_add(bank, q_type, difficulty, meta, questions):
+    """Add generated questions from the chunk described by `meta`. Returns the count kept."""
+    added = 0
+    for q in questions:
+        sig = minhash(q["question"], shingle=2)
+        if lsh_find(bank["lsh"], sig) is not None:
+            bank["dupes"] += 1
+            continue
+        item = {"id": bank["next_id"], "type": q_type, "difficulty": difficulty,
+                "doc": meta.doc, "page": meta.page_start, "question": q}
+        bank["next_id"] += 1
+        lsh_add(bank["lsh"], sig, item["id"])
+        bank["index"].setdefault(_bank_key(q_type, difficulty), []).append(len(bank["items"]))
+        bank["items"].append(item)
+        added += 1
+    return added
+
+
+def bank_drop_document(bank, doc_id):
+    """Forget every question generated from document `doc_id`."""
+    items = [it for it in bank["items"] if it["doc"] != doc_id]
+    fresh = empty_bank()
+    for it in items:
+        lsh_add(fresh["lsh"], minhash(it["question"]["question"], shingle=2), it["id"])
+        fresh["index"].setdefault(_bank_key(it["type"], it["difficulty"]), []).append(
+            len(fresh["items"]))
+        fresh["items"].append(it)
+    fresh["done"]    = {d for d in bank["done"] if d[0] != doc_id}
+    fresh["seen"]    = bank["seen"] & {it["id"] for it in items}
+    fresh["next_id"] = bank["next_id"]
+    fresh["dupes"]   = bank["dupes"]
+    bank.clear()
+    bank.update(fresh)
+
+
+def _bank_task(chunk, q_type, difficulty):
+    if q_type == "Multiple Choice":
+        return generate_mc_questions(chunk, difficulty, count=BANK_ITEMS_PER_CHUNK)
+    return generate_open_questions(chunk, difficulty, count=BANK_ITEMS_PER_CHUNK)
+
+
+def bank_pending(course, q_types, difficulties):
+    """(chunk_text, meta, type, difficulty) combinations the bank doesn't cover yet."""
+    done = (course.get("question_bank") or empty_bank())["done"]
+    return [(text, m, t, d)
+            for text, m in zip(course.get("chunks", []), course.get("chunk_meta", []))
+            for t in q_types for d in difficulties
+            if (m.doc, m.char_start, t, d) not in done]
+
+
+def build_question_bank(course, q_types, difficulties, on_progress=None, limit=None):
+    """
+    Generate questions for up to `limit` (default BANK_BUILD_LIMIT) of the
+    (chunk, type, difficulty) combinations not yet in the course bank,
+    BANK_CONCURRENCY calls at a time. Returns the number of questions added.
+    """
+    if not course.get("question_bank"):
+        course["question_bank"] = empty_bank()
+    bank  = course["question_bank"]
+    tasks = bank_pending(course, q_types, difficulties)[:limit or BANK_BUILD_LIMIT]
+    if not tasks:
+        return 0
+    added   = 0
+    ctx     = get_script_run_ctx()
+    workers = max(1, min(BANK_CONCURRENCY, len(tasks)))
+    with ThreadPoolExecutor(max_workers=workers,
+                            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+                            ) as pool:
+        futures = {pool.submit(_bank_task, text, t, d): (m, t, d) for text, m, t, d in tasks}
+        for done, fut in enumerate(as_completed(futures), 1):
+            m, t, d = futures[fut]
+            try:
+                qs = fut.result()
+            except Exception:
+                qs = []
+            if qs:                      # failed tasks stay pending for the next build
+                added += bank_add(bank, t, d, m, qs)
+                bank["done"].add((m.doc, m.char_start, t, d))
+            if on_progress:
+                on_progress(done, len(tasks))
+    return added
+
+
+def bank_available(course, q_type, difficulty):
+    """(total, unseen) questions in the bank for this type and difficulty."""
+    bank = course.get("question_bank")
+    if not bank:
+        return 0, 0
+    ids = [bank["items"][i]["id"] for i in bank["index"].get(_bank_key(q_type, difficulty), [])]
+    return len(ids), sum(i not in bank["seen"] for i in ids)
+
+
+def _spread(items, count):
+    """Up to `count` items, round-robin over their source pages in random order."""
+    strata = {}
+    for it in random.sample(items, len(items)):
+        strata.setdefault((it["doc"], it["page"]), []).append(it)
+    groups = list(strata.values())
+    picked = []
+    while groups and len(picked) < count:
+        for g in list(groups):
+            picked.append(g.pop())
+            if not g:
+                groups.remove(g)
+            if len(picked) == count:
+                break
+    return picked
+
+
+def draw_from_bank(course, q_type, difficulty, count):
+    """
+    Sample a question set from the bank without an AI call: unseen items
+    first, spread across the course's pages, then previously seen ones.
+    Marks the drawn items as seen. Returns [] if the bank can't fill it.
+    """
+    bank = course.get("question_bank")
+    if not bank or bank_available(course, q_type, difficulty)[0] < count:
+        return []
+    pool   = [bank["items"][i] for i in bank["index"][_bank_key(q_type, difficulty)]]
+    picked = _spread([it for it in pool if it["id"] not in bank["seen"]], count)
+    if len(picked) < count:
+        picked += _spread([it for it in pool if it["id"] in bank["seen"]], count - len(picked))
+    bank["seen"].update(it["id"] for it in picked)
+    return [json.loads(json.dumps(it["question"])) for it in picked]     # copies
 
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -828,6 +3530,100 @@ def score_summary(grades):
     return round(avg, 1), cat
 
 
+def grade_all(course, questions, answers, q_type, label="Grading", mode=None):
+    """
+    Grade a full exercise set or test with a live progress bar. Multiple
+    choice is graded locally; open-ended answers are graded concurrently
+    (one call each) or, with mode "batch", together in a single call.
+    """
+    mode = mode or GRADING_MODE
+    bar  = st.progress(0, text=f"{label}...")
+    if q_type == "Multiple Choice":
+        grades = [grade_mc(q, answers.get(i,"")) for i, q in enumerate(questions)]
+    elif mode == "batch":
+        ctx    = course_context_union(course, [grading_query(q, answers.get(i,""))
+                                               for i, q in enumerate(questions)])
+        grades = grade_open_batch(
+            ctx, [(q, answers.get(i,"")) for i, q in enumerate(questions)],
+            on_result=lambda done, total: bar.progress(
+                done / total, text=f"{label} — {done}/{total} graded..."),
+        )
+    else:
+        ctxs   = course_contexts(course, [grading_query(q, answers.get(i,""))
+                                          for i, q in enumerate(questions)])
+        grades = grade_open_concurrent(
+            [(ctxs[i], q, answers.get(i,"")) for i, q in enumerate(questions)],
+            on_result=lambda done, total: bar.progress(
+                done / total, text=f"{label} — {done}/{total} graded..."),
+        )
+    bar.empty()
+    return grades
+
+
+def show_grading_failures(grades):
+    failed = [i for i, g in enumerate(grades, 1) if g.get("error")]
+    if failed:
+        st.warning(f"⚠️ Question(s) {', '.join(map(str, failed))} could not be graded "
+                   f"(scored 0 for now). Submit again to retry.")
+
+
+def live_text(placeholder, css_class=None):
+    """on_text callback for call_ai that re-renders the streamed text in `placeholder`."""
+    def render(text):
+        if css_class:
+            placeholder.markdown(f'<div class="{css_class}">{text} ▌</div>',
+                                 unsafe_allow_html=True)
+        else:
+            placeholder.markdown(text + " ▌")
+    return render
+
+
+def bank_draw_button(course, q_type, difficulty, count, key):
+    """"Draw from Question Bank" button; returns the drawn set when clicked, else []."""
+    total, unseen = bank_available(course, q_type, difficulty)
+    if total < count:
+        return []
+    if st.button(f"🏦  Draw from Question Bank ({unseen} unseen of {total})", key=key):
+        return draw_from_bank(course, q_type, difficulty, count)
+    return []
+
+
+def render_question_bank(course, q_type, difficulty):
+    """Expander to build/extend the course's question bank and show its size."""
+    bank = course.get("question_bank") or empty_bank()
+    with st.expander(f"🏦 Question Bank — {len(bank['items'])} questions"):
+        st.caption(f"Generates {BANK_ITEMS_PER_CHUNK} questions per chunk for each type and "
+                   f"difficulty, so new sets can be drawn instantly without waiting on the AI. "
+                   f"Chunks already covered are skipped; each build makes at most "
+                   f"{BANK_BUILD_LIMIT} AI calls.")
+        c1, c2 = st.columns(2)
+        with c1:
+            types = st.multiselect("Types", BANK_TYPES, default=[q_type], key="bank_types")
+        with c2:
+            diffs = st.multiselect("Difficulties", BANK_DIFFICULTIES,
+                                   default=[difficulty], key="bank_diffs")
+        pending = len(bank_pending(course, types, diffs))
+        if pending:
+            st.caption(f"{pending} chunk × type × difficulty combination(s) still to generate.")
+        if st.button("⚙️  Build / Extend Bank", key="bank_build") and pending:
+            bar = st.progress(0.0, text="Generating questions...")
+            def on_progress(done, total):
+                bar.progress(done / total, text=f"Generating questions... {done}/{total} chunks")
+            added = build_question_bank(course, types, diffs, on_progress)
+            bar.empty()
+            st.success(f"Added {added} questions to the bank.")
+            st.rerun()
+        if bank["items"]:
+            rows = []
+            for t in BANK_TYPES:
+                for d in BANK_DIFFICULTIES:
+                    total, unseen = bank_available(course, t, d)
+                    if total:
+                        rows.append(f"{t} · {d}: **{total}** ({unseen} unseen)")
+            st.markdown("<br>".join(rows), unsafe_allow_html=True)
+            st.caption(f"{bank['dupes']} near-duplicate questions were dropped.")
+
+
 def progress_bar_html(pct, color="#6366F1"):
     return (f'<div class="prog-track">'
             f'<div class="prog-fill" style="width:{pct}%;background:{color};"></div>'
@@ -849,9 +3645,11 @@ def show_pipeline_explainer(wc, cc, fc):
     <div class="pipe-title">🔧 Pipeline Overview</div>
     <div class="pipe-body">
     <b>Extraction:</b> {fc} PDF(s) → {wc:,} words extracted via pdfplumber.<br>
-    <b>Chunking:</b> Split into {cc} chunks (~800 words each) to fit AI context window.<br>
-    <b>Context selection:</b> Top 2 chunks (~1,400 words) sent per AI call — simplified RAG.<br>
-    <b>Limitation:</b> Only the first ~1,400 words are used per request.
+    <b>Chunking:</b> Split into {cc} chunks (≤{CHUNK_TOKEN_BUDGET:,} tokens each) along headings,
+    code blocks and sentences, each tagged with its document and pages.<br>
+    <b>Indexing:</b> A BM25 keyword index and a hashed TF-IDF vector matrix are built over all chunks.<br>
+    <b>Context selection:</b> The 2 chunks most relevant to each request
+    are sent per AI call — simplified RAG.
     </div></div>""", unsafe_allow_html=True)
 
 
@@ -1005,6 +3803,10 @@ def page_dashboard():
                 go("class","files"); st.rerun()
             else:
                 st.warning("Enter a course name first.")
+    if ADMIN_PAGE:
+        st.write("")
+        if st.button("🛠  Admin — Metrics", key="admin_open"):
+            go("admin"); st.rerun()
 
 
 def page_class():
@@ -1034,35 +3836,70 @@ def section_files(course):
     st.markdown("### 📂 Course Files")
     with st.expander("❓ How document processing works"):
         st.markdown("""
-**1. Text extraction** — pdfplumber reads every page of your PDFs.
-**2. Chunking** — text is split into ~800-word chunks to fit the AI context window.
-**3. Context selection** — top 2 chunks (~1,400 words) are sent per AI call (simplified RAG).
-**Limitation:** Content beyond the first ~1,400 words may not be seen by the AI.
+**1. Text extraction** — pdfplumber reads every page of your PDFs. Large uploads
+are split into page ranges and read in parallel worker processes. Files you have
+uploaded before (in any course) are served from a local cache instead. Adding files
+later only processes the new ones; removing a file drops just its chunks.
+**2. Chunking** — text is split along headings, code blocks and sentences into chunks of
+at most ~1,000 tokens (with a small overlap), each tagged with its document and page numbers.
+**3. Indexing** — a BM25 keyword index and a hashed TF-IDF vector matrix are built over all chunks.
+**4. Context selection** — the 2 chunks most relevant to each question, answer or chat
+message are sent per AI call (simplified RAG). The study guide, which has
+no specific question, still uses the first 2 chunks.
         """)
     uploaded = st.file_uploader("Select PDFs — hold Ctrl for multiple",
                                  type=["pdf"], accept_multiple_files=True)
     if uploaded:
-        if st.button("📥  Process All Files", key="proc"):
-            with st.spinner("Reading..."):
-                chunks, names, wc = process_multiple_pdfs(uploaded)
-            if not chunks:
+        if st.button("📥  Add Files to Course", key="proc"):
+            had_material = bool(course.get("chunks"))
+            bar = st.progress(0, text="Reading...")
+            names, skipped, wc, folded = add_documents(
+                course, uploaded,
+                on_page=lambda done, total, name: bar.progress(
+                    done / total, text=f"Reading {name} — page {done}/{total}..."),
+            )
+            bar.empty()
+            if not names and not skipped:
                 st.error("Could not extract text. Use text-based PDFs.")
+            elif not names:
+                st.info(f"Already in this course: {', '.join(skipped)}")
             else:
-                set_key("chunks",     chunks)
-                set_key("file_names", names)
-                for k in ("study_guide","flashcards","exercises","exercise_grades",
-                          "test_questions","test_grades","diagnostic"):
-                    set_key(k, [] if k in ("flashcards","exercises","exercise_grades",
-                                            "test_questions","test_grades") else "")
-                st.success(f"✅ {len(names)} file(s) — {wc:,} words in {len(chunks)} chunks.")
-                show_pipeline_explainer(wc, len(chunks), len(names))
+                # Shown after the rerun below (see upload_notices)
+                notes = [("success", f"✅ Added {len(names)} file(s) — {wc:,} words. "
+                                     f"Knowledge base: {len(course['chunks'])} chunks.")]
+                if skipped:
+                    notes.append(("info", f"Already in this course: {', '.join(skipped)}"))
+                if folded:
+                    notes.append(("info", f"♻️ {folded} near-duplicate chunk(s) folded "
+                                          f"into existing material."))
+                notes.append(("pipeline", (wc, len(course["chunks"]), len(course["file_names"]))))
+                if had_material and course.get("study_guide"):
+                    notes.append(("info", "Regenerate your study guide to include the new material."))
+                st.session_state.upload_notices = notes
                 st.rerun()
+    for kind, payload in st.session_state.pop("upload_notices", []):
+        if kind == "pipeline":
+            show_pipeline_explainer(*payload)
+        else:
+            getattr(st, kind)(payload)
     fns = course.get("file_names",[])
     if fns:
         st.write("")
-        for fn in fns:
-            st.markdown(f'<span class="file-chip">📄 {fn}</span>', unsafe_allow_html=True)
+        doc_ids = course.get("doc_ids", [])
+        for i, fn in enumerate(fns):
+            c1,c2 = st.columns([6,1])
+            with c1:
+                st.markdown(f'<span class="file-chip">📄 {fn}</span>', unsafe_allow_html=True)
+            with c2:
+                if i < len(doc_ids) and st.button("🗑 Remove", key=f"rm_doc_{doc_ids[i]}",
+                                                  use_container_width=True):
+                    remove_document(course, doc_ids[i])
+                    st.rerun()
         st.info(f"Knowledge base: **{len(course['chunks'])} chunks** ready.")
+        dd = course.get("dedup_stats") or {}
+        if dd.get("chunks"):
+            st.caption(f"♻️ {dd['chunks']} near-duplicate chunk(s) folded across uploads "
+                       f"(~{dd['tokens']:,} tokens of repeated material kept out of retrieval).")
         with st.expander("Preview (first 300 words)"):
             st.write(" ".join(course["chunks"][0].split()[:300]) + "...")
     else:
@@ -1086,12 +3923,14 @@ def section_study_guide(course):
                                                   "Bullet explanations",
                                                   "Paragraph explanations"])
         if st.button("✨  Generate Study Guide", key="gen_guide"):
-            ctx = get_context(course["chunks"])
-            with st.spinner("Writing study guide..."):
-                g = generate_study_guide(ctx, tone, depth, fmt)
+            ctx = course_context(course)
+            live = st.empty()
+            live.caption("✍️ Writing study guide...")
+            g = generate_study_guide(ctx, tone, depth, fmt, on_text=live_text(live))
             if g:
                 set_key("study_guide", g)
                 set_key("flashcards", [])  # reset flashcards when guide regenerated
+                prefetch_after_guide(course)
                 st.success("Done! Switch to **View Guide** tab.")
                 st.rerun()
 
@@ -1123,10 +3962,21 @@ def section_flashcards(course):
         st.warning("Generate a Study Guide first — flashcards are created from it.")
         return
 
+    guide = course["study_guide"]
+    if not course.get("flashcards") and prefetch_ready(course, "flashcards", guide):
+        cards = take_prefetch(course, "flashcards", guide)
+        if cards:
+            set_key("flashcards", cards)
+            st.caption(f"⚡ Prepared in the background while you read the study guide "
+                       f"({prefetch_summary()['hit_rate']:.0%} of background sets used so far).")
+
     if st.button("✨  Generate Flashcards", key="gen_fc"):
-        ctx = get_context(course["chunks"])
         with st.spinner("Creating flashcards..."):
-            cards = generate_flashcards(ctx, course["study_guide"])
+            cards = take_prefetch(course, "flashcards", guide) if not course.get("flashcards") else None
+            if not cards:
+                cancel_prefetch(course, "flashcards")
+                ctx   = course_context(course, query=guide)
+                cards = generate_flashcards(ctx, guide)
         if cards:
             set_key("flashcards", cards)
             st.success(f"{len(cards)} flashcards created!")
@@ -1228,12 +4078,11 @@ def section_exercises(course):
                     unsafe_allow_html=True)
 
     if st.button("🔄  Generate Questions", key="gen_ex"):
-        ctx = get_context(course["chunks"])
         with st.spinner("Generating questions..."):
-            if q_type == "Multiple Choice":
-                qs = generate_mc_questions(ctx, difficulty, count=6)
-            else:
-                qs = generate_open_questions(ctx, difficulty, count=6)
+            qs = take_prefetch(course, "exercises", (q_type, difficulty))
+            if not qs:
+                ctx = course_context(course, query=course.get("study_guide"))
+                qs  = generate_exercises(ctx, q_type, difficulty)
         if qs:
             set_key("exercises",       qs)
             set_key("exercise_answers",{})
@@ -1245,6 +4094,16 @@ def section_exercises(course):
         else:
             st.error("Could not generate questions. Try again.")
 
+    qs = bank_draw_button(course, q_type, difficulty, 6, key="bank_ex")
+    if qs:
+        set_key("exercises",       qs)
+        set_key("exercise_answers",{})
+        set_key("exercise_grades", [])
+        set_key("ex_q_type",       q_type)
+        set_key("ex_difficulty",   difficulty)
+        st.rerun()
+    render_question_bank(course, q_type, difficulty)
+
     exercises = course.get("exercises",[])
     if not exercises:
         st.info("Click above to generate questions.")
@@ -1283,17 +4142,7 @@ def section_exercises(course):
     set_key("exercise_answers", answers)
 
     if st.button("📊  Submit for Grading", key="grade_ex", use_container_width=True):
-        ctx    = get_context(course["chunks"])
-        grades = []
-        bar    = st.progress(0, text="Grading...")
-        for i, q in enumerate(exercises):
-            bar.progress((i+1)/len(exercises), text=f"Grading {i+1}/{len(exercises)}...")
-            if stored_type == "Multiple Choice":
-                g = grade_mc(q, answers.get(i,""))
-            else:
-                g = grade_open(ctx, q, answers.get(i,""))
-            grades.append(g)
-        bar.empty()
+        grades = grade_all(course, exercises, answers, stored_type, "Grading")
         set_key("exercise_grades", grades)
         st.success("Graded!"); st.rerun()
 
@@ -1308,6 +4157,7 @@ def section_exercises(course):
     m1.metric("Average Score", f"{avg} / 10")
     m2.metric("Level", cat)
 
+    show_grading_failures(grades)
     show_accuracy_disclaimer()
     st.write("")
 
@@ -1364,7 +4214,7 @@ def section_test(course):
             st.info(f"⏱️ Timer: **{mins} minutes**")
 
         if st.button("🎯  Generate Test", key="gen_test"):
-            ctx = get_context(course["chunks"])
+            ctx = course_context(course, query=course.get("study_guide"))
             with st.spinner("Creating exam..."):
                 if q_type == "Multiple Choice":
                     qs = generate_mc_questions(ctx, difficulty, count=5)
@@ -1382,6 +4232,17 @@ def section_test(course):
             else:
                 st.error("Could not generate test. Try again.")
 
+        qs = bank_draw_button(course, q_type, difficulty, 5, key="bank_test")
+        if qs:
+            set_key("test_questions",  qs)
+            set_key("test_answers",    {})
+            set_key("test_grades",     [])
+            set_key("test_q_type",     q_type)
+            set_key("test_difficulty", difficulty)
+            set_key("test_start_time", time.time())
+            set_key("test_submitted",  False)
+            st.rerun()
+
         grades = course.get("test_grades",[])
         if grades:
             st.write("")
@@ -1390,6 +4251,7 @@ def section_test(course):
             m1,m2    = st.columns(2)
             m1.metric("Score", f"{avg} / 10")
             m2.metric("Result", cat)
+            show_grading_failures(grades)
             stored_type = course.get("test_q_type","Open-ended")
             for i, g in enumerate(grades, 1):
                 with st.expander(f"Q{i} — {g['score']}/10"):
@@ -1487,17 +4349,7 @@ def section_test(course):
         do_submit = True
 
     if do_submit:
-        ctx    = get_context(course["chunks"])
-        grades = []
-        bar    = st.progress(0, text="Grading test...")
-        for i, q in enumerate(test_qs):
-            bar.progress((i+1)/len(test_qs), text=f"Grading {i+1}/{len(test_qs)}...")
-            if stored_type == "Multiple Choice":
-                g = grade_mc(q, answers.get(i,""))
-            else:
-                g = grade_open(ctx, q, answers.get(i,""))
-            grades.append(g)
-        bar.empty()
+        grades = grade_all(course, test_qs, answers, stored_type, "Grading test")
         set_key("test_grades",   grades)
         set_key("test_submitted", True)
         st.success("Test submitted and graded!")
@@ -1530,7 +4382,6 @@ def section_progress(course):
     st.write("")
 
     if all_g:
-        import pandas as pd
         cd = {}
         for i,g in enumerate(ex_g, 1):
             cd[f"Ex Q{i}"] = g["score"]
@@ -1579,7 +4430,7 @@ def section_diagnostics(course):
     st.metric("Overall", f"{avg}/10 — {cat}")
     st.write("")
     if st.button("🧠  Generate Diagnostic", key="gen_diag"):
-        ctx   = get_context(course.get("chunks",[]))
+        ctx   = course_context(course, query=" ".join(g["question"] for g in all_g))
         qtype = course.get("test_q_type") or course.get("ex_q_type","Open-ended")
         with st.spinner("Analysing performance..."):
             r = generate_diagnostic(ctx, all_g, qtype)
@@ -1613,8 +4464,24 @@ def section_chat(course):
         if msgs:
             for m in msgs:
                 cls = "chat-user" if m["role"]=="user" else "chat-ai"
-                st.markdown(f'<div class="{cls}">{m["content"]}</div>',
+                badge = ""
+                if m.get("cached_match"):
+                    badge = (f'<div class="chat-badge">⚡ Cached answer — a similar question '
+                             f'was answered before ({m["cached_match"]:.0%} match)</div><br>')
+                st.markdown(f'<div class="{cls}">{badge}{m["content"]}</div>',
                             unsafe_allow_html=True)
+            if msgs[-1].get("cached_match"):
+                if st.button("↻ Get a fresh answer", key="chat_fresh"):
+                    msgs.pop()
+                    ctx = course_context(course, query=msgs[-1]["content"])
+                    live = st.empty()
+                    live.caption("💭 AI Teacher is thinking...")
+                    reply, _ = teacher_answer(course, ctx, msgs, fresh=True,
+                                              on_text=live_text(live, "chat-ai"),
+                                              memory=st.session_state.global_memory)
+                    if reply:
+                        msgs.append({"role":"assistant","content":reply})
+                    st.rerun()
             st.write("")
 
         user_input = st.text_input("Ask a question...",
@@ -1626,17 +4493,29 @@ def section_chat(course):
             send = st.button("Send →", key="chat_send", use_container_width=True)
         with c2:
             if st.button("Clear", key="chat_clear"):
-                st.session_state.global_chat = []; st.rerun()
+                st.session_state.global_chat   = []
+                st.session_state.global_memory = new_chat_memory(); st.rerun()
+        ac = answer_cache_summary()
+        if ac["hits"]:
+            st.caption(f"⚡ {ac['hits']} of {ac['lookups']} questions ({ac['hit_rate']:.0%}) "
+                       f"on this server were answered instantly from earlier answers to the same course material.")
+        mem = st.session_state.global_memory
+        if mem["summary"]:
+            st.caption(f"🧠 Older messages are summarised — ~{mem['saved']:,} prompt tokens "
+                       f"saved in this chat so far.")
 
         if send and user_input.strip():
             st.session_state.global_chat.append(
                 {"role":"user","content":user_input.strip()})
-            ctx = get_context(course["chunks"])
-            with st.spinner("AI Teacher is thinking..."):
-                reply = chat_with_teacher(ctx, st.session_state.global_chat)
+            ctx = course_context(course, query=user_input.strip())
+            live = st.empty()
+            live.caption("💭 AI Teacher is thinking...")
+            reply, cached_match = teacher_answer(course, ctx, st.session_state.global_chat,
+                                                on_text=live_text(live, "chat-ai"),
+                                                memory=st.session_state.global_memory)
             if reply:
                 st.session_state.global_chat.append(
-                    {"role":"assistant","content":reply})
+                    {"role":"assistant","content":reply,"cached_match":cached_match})
             st.rerun()
 
     # ── Contextual Chat ───────────────────────────────────────────────────────
@@ -1676,15 +4555,18 @@ def section_chat(course):
             ctx_send = st.button("Ask →", key="ctx_send", use_container_width=True)
         with c2:
             if st.button("Clear", key="ctx_clear"):
-                st.session_state.context_chat = []; st.rerun()
+                st.session_state.context_chat   = []
+                st.session_state.context_memory = new_chat_memory(); st.rerun()
 
         if ctx_send and ctx_q.strip() and highlight.strip():
             st.session_state.context_chat.append(
                 {"role":"user","content":ctx_q.strip()})
-            ctx = get_context(course["chunks"])
-            with st.spinner("Explaining..."):
-                reply = contextual_chat(ctx, highlight.strip(),
-                                         st.session_state.context_chat)
+            ctx = course_context(course, query=f"{highlight.strip()} {ctx_q.strip()}")
+            live = st.empty()
+            live.caption("💭 Explaining...")
+            reply = contextual_chat(ctx, highlight.strip(), st.session_state.context_chat,
+                                    on_text=live_text(live, "chat-ai"),
+                                    memory=st.session_state.context_memory)
             if reply:
                 st.session_state.context_chat.append(
                     {"role":"assistant","content":reply})
@@ -1693,6 +4575,92 @@ def section_chat(course):
             st.warning("Paste the text you want to ask about first.")
 
 
+# ── Admin (metrics) ───────────────────────────────────────────────────────────
+
+def admin_unlocked():
+    """True once this session has entered ADMIN_TOKEN; otherwise shows the prompt."""
+    if not ADMIN_TOKEN:
+        st.error("Set ADMIN_TOKEN in `.env` to use the admin page.")
+        return False
+    if st.session_state.get("admin_ok"):
+        return True
+    token = st.text_input("Admin token", type="password", key="admin_token")
+    if token and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        st.session_state.admin_ok = True
+        return True
+    if token:
+        st.error("Wrong admin token.")
+    return False
+
+
+def page_admin():
+    render_top_bar("Admin — Metrics", "Where time and quota go (this server process)")
+    if st.button("← Back", key="admin_back"):
+        go("dashboard"); st.rerun()
+
+    if not admin_unlocked():
+        return
+    snap = telemetry_snapshot()
+    labels = snap["labels"]
+    if not labels:
+        st.info("No AI calls recorded yet.")
+    else:
+        rows = []
+        for label, s in sorted(labels.items()):
+            h = s["hist"]["call_seconds"]
+            rows.append({"call": label, "calls": s["calls"], "tasks": s["tasks"],
+                         "cache hits": s["cache_hits"], "coalesced": s["coalesced"],
+                         "retries": s["retries"], "errors": sum(s["errors"].values()),
+                         "prompt tok": s["prompt_tokens"], "response tok": s["response_tokens"],
+                         "est. cost $": round(s["cost_usd"], 4),
+                         "mean s": round(h["sum"] / h["count"], 2) if h["count"] else None})
+        st.dataframe(pd.DataFrame(rows).set_index("call"), use_container_width=True)
+
+        c1, c2 = st.columns(2)
+        with c1:
+            label = st.selectbox("Call", sorted(labels), key="admin_label")
+        with c2:
+            hist = st.selectbox("Histogram", list(HISTOGRAMS), key="admin_hist")
+        h = labels[label]["hist"][hist]
+        buckets = [f"≤{b:g}" for b in HISTOGRAMS[hist]] + ["more"]
+        df = pd.DataFrame({"bucket": buckets, "count": h["buckets"]}).set_index("bucket")
+        st.bar_chart(df, height=240)
+        errors = labels[label]["errors"]
+        if errors:
+            st.caption("Errors: " + ", ".join(f"{k} × {v}" for k, v in sorted(errors.items())))
+
+    with st.expander("Caches, limiter and router"):
+        st.json({
+            "response_cache": dict(response_cache_stats),
+            "pdf_cache":      dict(pdf_cache_stats),
+            "model_pool":     model_pool_summary(),
+            "rate_limit":     dict(rate_limit_stats),
+            "single_flight":  single_flight_summary(),
+            "router":         router_summary(),
+            "prefetch":       prefetch_summary(),
+            "answer_cache":   answer_cache_summary(),
+            "chat_memory":    chat_memory_summary(),
+            "json_items":     dict(json_item_stats),
+        })
+
+    st.markdown("---")
+    c1, c2, c3, c4 = st.columns(4)
+    with c1:
+        if st.button("💾 Write files", key="admin_write", use_container_width=True):
+            st.success(f"Written to {write_telemetry()}")
+    with c2:
+        st.download_button("⬇️ JSON", data=json.dumps(snap, indent=2),
+                           file_name="telemetry.json", mime="application/json",
+                           use_container_width=True)
+    with c3:
+        st.download_button("⬇️ CSV", data=_csv_rows(labels), file_name="telemetry.csv",
+                           mime="text/csv", use_container_width=True)
+    with c4:
+        st.download_button("⬇️ Prometheus", data=prometheus_text(labels),
+                           file_name="metrics.prom", mime="text/plain",
+                           use_container_width=True)
+
+
 # ── Notebook ──────────────────────────────────────────────────────────────────
 
 def page_notebook():
@@ -1818,12 +4786,14 @@ def main():
     )
     inject_css()
     init_session_state()
+    warm_model_discovery()
 
     p = st.session_state.page
     if   p == "landing":   page_landing()
     elif p == "dashboard": page_dashboard()
     elif p == "class":     page_class()
     elif p == "notebook":  page_notebook()
+    elif p == "admin" and ADMIN_PAGE: page_admin()
     else:                  page_landing()
 
 
@@ -0,0 +1,250 @@
+"""
+Offline benchmark — Adaptive AI Learning Companion
+==================================================
+Drives ingestion of R_Demo_Document.pdf, retrieval, generation, grading and
+chat through app.py with the fake LLM backend (LLM_BACKEND=fake), so runs
+need no API key, cost nothing and are repeatable. Prints per-stage timings
+and can save them as JSON to compare against a run from another commit:
+
+    python benchmark.py --repeat 5 --out before.json
+    git checkout my-branch
+    python benchmark.py --repeat 5 --compare before.json
+
+Simulated model latency comes from FAKE_LATENCY_MS / FAKE_MS_PER_TOKEN
+(lowered by default here so the app's own overhead is visible); pass
+--latency-ms / --ms-per-token to change them.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import warnings
+import statistics
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PDF  = os.path.join(HERE, "R_Demo_Document.pdf")
+
+QUESTIONS = [
+    "What is a data frame in R?",
+    "How do you install and load a package?",
+    "What does the pipe operator do?",
+    "How are vectors different from lists?",
+    "How do you read a CSV file?",
+]
+
+
+class Upload:
+    """The parts of a Streamlit UploadedFile that add_documents uses."""
+    def __init__(self, path):
+        self.name = os.path.basename(path)
+        with open(path, "rb") as fh:
+            self._data = fh.read()
+
+    def getvalue(self):
+        return self._data
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[1],
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--repeat", type=int, default=3, help="runs of every stage (default 3)")
+    p.add_argument("--latency-ms", default="50", help="simulated time to first token")
+    p.add_argument("--ms-per-token", default="0.1", help="simulated generation cost per token")
+    p.add_argument("--error-rate", default="0", help="share of model calls that fail")
+    p.add_argument("--stages", help="comma-separated subset of stages to run")
+    p.add_argument("--out", help="write results as JSON to this file")
+    p.add_argument("--compare", help="JSON from an earlier run to print deltas against")
+    return p.parse_args()
+
+
+def configure(args, workdir):
+    """Environment for app.py; must be set before it is imported."""
+    os.environ["LLM_BACKEND"]       = "fake"
+    os.environ["FAKE_LATENCY_MS"]   = str(args.latency_ms)
+    os.environ["FAKE_MS_PER_TOKEN"] = str(args.ms_per_token)
+    os.environ["FAKE_ERROR_RATE"]   = str(args.error_rate)
+    os.environ["PDF_CACHE_DIR"]      = os.path.join(workdir, "pdf_text")
+    os.environ["RESPONSE_CACHE_DIR"] = os.path.join(workdir, "responses")
+    os.environ["TELEMETRY_DIR"]      = os.path.join(workdir, "telemetry")
+    os.environ.setdefault("RESPONSE_CACHE_TTL", "0")        # every call reaches the model
+    os.environ.setdefault("RATE_LIMIT_RPM", "100000")       # measure the app, not the quota
+    os.environ.setdefault("MODEL_ROUTING", "fixed")         # same model on every run
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_stages(app):
+    """Ordered {name: fn}; each fn(state) runs one stage and may stash results in state."""
+    def ingest_cold(s):
+        shutil.rmtree(app.PDF_CACHE_DIR, ignore_errors=True)
+        s["course"] = app.empty_course()
+        app.add_documents(s["course"], [Upload(PDF)])
+
+    def ingest_warm(s):
+        s["course"] = app.empty_course()
+        app.add_documents(s["course"], [Upload(PDF)])
+
+    def retrieval(s):
+        for i in range(200):
+            app.course_context(s["course"], query=QUESTIONS[i % len(QUESTIONS)])
+        s["context"] = app.course_context(s["course"])
+
+    def study_guide(s):
+        s["guide"] = app.generate_study_guide(s["context"], "Simple language",
+                                              "Overview", "Structured headings")
+
+    def flashcards(s):
+        app.generate_flashcards(s["context"], s["guide"])
+
+    def mc_questions(s):
+        app.generate_mc_questions(s["context"], "Medium", 5)
+
+    def open_questions(s):
+        s["open"] = app.generate_open_questions(s["context"], "Medium", 5)
+
+    def answers(s):
+        return [(q, f"{q['rubric_focus']}. " * (i + 1)) for i, q in enumerate(s["open"])]
+
+    def grade_concurrent(s):
+        app.grade_open_concurrent([(s["context"], q, a) for q, a in answers(s)])
+
+    def grade_batch(s):
+        app.grade_open_batch(s["context"], answers(s))
+
+    def diagnostic(s):
+        grades = app.grade_open_batch(s["context"], answers(s))
+        app.generate_diagnostic(s["context"], grades, "Open-ended")
+
+    def chat(s):
+        memory = app.new_chat_memory()
+        messages = []
+        for q in QUESTIONS:
+            messages.append({"role": "user", "content": q})
+            reply, _ = app.teacher_answer(s["course"], s["context"], messages,
+                                          fresh=True, memory=memory)
+            messages.append({"role": "assistant", "content": reply})
+
+    def chat_cached(s):
+        for q in QUESTIONS:
+            app.teacher_answer(s["course"], s["context"], [{"role": "user", "content": q}])
+
+    def question_bank(s):
+        s["course"]["question_bank"] = None
+        app.build_question_bank(s["course"], ["Multiple Choice"], ["Medium"])
+
+    return {f.__name__: f for f in (ingest_cold, ingest_warm, retrieval, study_guide,
+                                    flashcards, mc_questions, open_questions,
+                                    grade_concurrent, grade_batch, diagnostic, chat,
+                                    chat_cached, question_bank)}
+
+
+def model_calls(app):
+    """(calls that reached the model, tokens sent + received) so far, over all labels."""
+    labels = app.telemetry_snapshot()["labels"].values()
+    return (sum(l["calls"] - l["cache_hits"] - l["coalesced"] for l in labels),
+            sum(l["prompt_tokens"] + l["response_tokens"] for l in labels))
+
+
+def run(app, stages, repeat, only=None):
+    """
+    Run every stage `repeat` times. With `only`, the other stages still run
+    (later stages need their results) but only those in `only` are reported.
+    """
+    names = [n for n in stages if not only or n in only]
+    last  = list(stages).index(names[-1])
+    results = {name: {"seconds": [], "ai_calls": 0, "tokens": 0} for name in names}
+    for _ in range(repeat):
+        state = {}
+        for name, fn in list(stages.items())[:last + 1]:
+            if name not in results:
+                fn(state)
+                continue
+            calls, tokens = model_calls(app)
+            started = time.perf_counter()
+            fn(state)
+            elapsed = time.perf_counter() - started
+            after_calls, after_tokens = model_calls(app)
+            r = results[name]
+            r["seconds"].append(elapsed)
+            r["ai_calls"] += after_calls - calls
+            r["tokens"]   += after_tokens - tokens
+    for r in results.values():
+        s = r["seconds"]
+        r.update(median_ms=statistics.median(s) * 1000, min_ms=min(s) * 1000,
+                 max_ms=max(s) * 1000, ai_calls=r["ai_calls"] / repeat,
+                 tokens=r["tokens"] / repeat)
+    return results
+
+
+def report(results, baseline=None):
+    head = f"{'stage':<18}{'median ms':>11}{'min ms':>10}{'max ms':>10}{'AI calls':>10}{'tokens':>9}"
+    if baseline:
+        head += f"{'baseline':>11}{'change':>9}"
+    print(head)
+    print("─" * len(head))
+    for name, r in results.items():
+        line = (f"{name:<18}{r['median_ms']:>11.1f}{r['min_ms']:>10.1f}{r['max_ms']:>10.1f}"
+                f"{r['ai_calls']:>10.1f}{r['tokens']:>9.0f}")
+        old = (baseline or {}).get(name)
+        if old:
+            change = (r["median_ms"] - old["median_ms"]) / old["median_ms"] * 100 if old["median_ms"] else 0.0
+            line += f"{old['median_ms']:>11.1f}{change:>+8.1f}%"
+        print(line)
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="alc-bench-")
+    configure(args, workdir)
+
+    # Importing app outside `streamlit run` logs "missing ScriptRunContext" warnings
+    logging.disable(logging.WARNING)
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    sys.path.insert(0, HERE)
+    import app
+
+    stages = make_stages(app)
+    wanted = args.stages.split(",") if args.stages else None
+    unknown = set(wanted or []) - set(stages)
+    if unknown:
+        sys.exit(f"Unknown stage(s): {', '.join(sorted(unknown))}. "
+                 f"Choose from: {', '.join(stages)}")
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as fh:
+            baseline = json.load(fh)["stages"]
+
+    try:
+        results = run(app, stages, args.repeat, wanted)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"commit {git_commit() or '?'} · {args.repeat} run(s) · fake latency "
+          f"{args.latency_ms} ms + {args.ms_per_token} ms/token · error rate {args.error_rate}")
+    report(results, baseline)
+
+    if args.out:
+        out = {"commit": git_commit(), "created": time.time(), "repeat": args.repeat,
+               "config": {"latency_ms": args.latency_ms, "ms_per_token": args.ms_per_token,
+                          "error_rate": args.error_rate},
+               "stages": results}
+        with open(args.out, "w", encoding="utf-8") as fh:
+            json.dump(out, fh, indent=2)
+        print(f"\nSaved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""
+Load test — Adaptive AI Learning Companion
+==========================================
+Simulates N students using one Streamlit server at once. Every session is a
+streamlit.testing.v1.AppTest running app.py in this process, so sessions
+share the process-wide caches and pools just as they do on a real server,
+and every AI call goes to the fake LLM backend (LLM_BACKEND=fake). Each
+session makes the same visit:
+
+    create course → upload R_Demo_Document.pdf → study guide →
+    open-ended exercises → grading → AI Teacher chat
+
+For each N in --sessions it reports throughput, per-rerun p50/p99 latency
+and memory per session:
+
+    python loadtest.py --sessions 1,5,10,20 --out load.json
+
+Sessions upload the same PDF and ask the same questions, like a class
+working through one course, so later sessions hit the shared caches;
+--no-cache makes every AI call reach the (fake) model.
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import warnings
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark import HERE, PDF, QUESTIONS, git_commit
+
+APP = os.path.join(HERE, "app.py")
+
+STEPS = ["open", "get_started", "create_course", "choose_file", "upload",
+         "open_guide", "study_guide", "open_exercises", "choose_type", "exercises",
+         "grade", "open_chat", "chat"]
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[1],
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--sessions", default="1,2,4,8", help="comma-separated session counts")
+    p.add_argument("--think-ms", type=float, default=0,
+                   help="pause between a student's actions (default 0 = back to back)")
+    p.add_argument("--questions", type=int, default=2, help="chat questions per visit")
+    p.add_argument("--latency-ms", default="300", help="simulated time to first token")
+    p.add_argument("--ms-per-token", default="1", help="simulated generation cost per token")
+    p.add_argument("--error-rate", default="0", help="share of model calls that fail")
+    p.add_argument("--no-cache", action="store_true", help="disable the response cache")
+    p.add_argument("--timeout", type=float, default=120, help="seconds allowed per rerun")
+    p.add_argument("--out", help="write results as JSON to this file")
+    return p.parse_args()
+
+
+def configure(args, workdir):
+    """Environment for app.py; must be set before the first session runs it."""
+    os.environ["LLM_BACKEND"]        = "fake"
+    os.environ["FAKE_LATENCY_MS"]    = str(args.latency_ms)
+    os.environ["FAKE_MS_PER_TOKEN"]  = str(args.ms_per_token)
+    os.environ["FAKE_ERROR_RATE"]    = str(args.error_rate)
+    os.environ["PDF_CACHE_DIR"]      = os.path.join(workdir, "pdf_text")
+    os.environ["RESPONSE_CACHE_DIR"] = os.path.join(workdir, "responses")
+    os.environ["TELEMETRY_DIR"]      = os.path.join(workdir, "telemetry")
+    os.environ.setdefault("RATE_LIMIT_RPM", "100000")       # measure the app, not the quota
+    if args.no_cache:
+        os.environ["RESPONSE_CACHE_TTL"] = "0"
+
+
+def allow_concurrent_apptests():
+    """
+    AppTest is built for one test at a time. Three pieces of global state make
+    parallel runs crash, so patch them for this process only:
+    - each run installs a mock Runtime singleton and clears it when done,
+      pulling it out from under runs still in progress → keep the last one;
+    - each run recompiles the script with a fresh ScriptCache, and parallel
+      compiles can trip a CPython 3.11 ast bug → compile once, like a real
+      server does;
+    - each run turns global.appTest on by swapping out config.get_option and
+      swaps it back when done, turning it off under runs still in progress —
+      their widgets then skip the test hooks and the next run fails with
+      KeyError '$$ID-…' → turn it on once for the whole process.
+    """
+    from streamlit import config
+    from streamlit.runtime.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import app_test
+
+    last = {}
+    def instance(cls):
+        if cls._instance is not None:
+            last["runtime"] = cls._instance
+        elif "runtime" not in last:
+            raise RuntimeError("Runtime hasn't been created!")
+        return cls._instance or last["runtime"]
+    Runtime.instance = classmethod(instance)
+    Runtime.exists   = classmethod(lambda cls: cls._instance is not None or "runtime" in last)
+
+    compile_script = ScriptCache.get_bytecode
+    compiled, lock = {}, threading.Lock()
+    def get_bytecode(self, script_path):
+        with lock:
+            if script_path not in compiled:
+                compiled[script_path] = compile_script(self, script_path)
+            return compiled[script_path]
+    ScriptCache.get_bytecode = get_bytecode
+
+    config.set_option("global.appTest", True)
+    app_test.patch_config_options = lambda overrides: nullcontext()
+
+
+def visit(n, args, pdf_bytes):
+    """One student's visit. Returns (AppTest, [(step, seconds)], error or None)."""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP, default_timeout=args.timeout)
+    timings = []
+    current = [STEPS[0]]                # step being prepared or run, for failure reports
+
+    def step(name):
+        current[0] = name
+        started = time.perf_counter()
+        at.run()
+        timings.append((name, time.perf_counter() - started))
+        if at.exception:
+            raise RuntimeError(f"{name}: {at.exception[0].message}")
+        if args.think_ms:
+            time.sleep(args.think_ms / 1000)
+        current[0] = STEPS[min(len(timings), len(STEPS) - 1)]
+
+    try:
+        step("open")
+        next(b for b in at.button if "Get Started" in b.label).click()
+        step("get_started")
+        at.text_input(key="new_course_input").input(f"R Programming {n}")
+        at.button(key="create_btn").click()
+        step("create_course")
+        at.file_uploader[0].set_value((os.path.basename(PDF), pdf_bytes, "application/pdf"))
+        step("choose_file")
+        at.button(key="proc").click()
+        step("upload")
+        at.button(key="sb_guide").click()
+        step("open_guide")
+        at.button(key="gen_guide").click()
+        step("study_guide")
+        at.button(key="sb_exercises").click()
+        step("open_exercises")
+        at.selectbox(key="ex_type").set_value("Open-ended")
+        step("choose_type")
+        at.button(key="gen_ex").click()
+        step("exercises")
+        for area in at.text_area:
+            if area.key and area.key.startswith("ex_oe_"):
+                area.input("A data frame holds columns of values; packages add functions. "
+                           * (1 + int(area.key.rsplit("_", 1)[1]) % 3))
+        at.button(key="grade_ex").click()
+        step("grade")
+        at.button(key="sb_chat").click()
+        step("open_chat")
+        for q in (QUESTIONS * args.questions)[:args.questions]:
+            at.text_input(key="chat_input").input(q)
+            at.button(key="chat_send").click()
+            step("chat")
+    except Exception as err:                    # one failed visit doesn't stop the run
+        return at, timings, f"{current[0]}: {type(err).__name__}: {err} — {page_state(at)}"
+    return at, timings, None
+
+
+def page_state(at):
+    """
+    What the session's page showed when a visit failed: where it was, how many
+    chunks its course held, and any warnings or errors on the page — enough to
+    tell an app problem (e.g. "Upload files first.") from a harness one.
+    """
+    try:
+        state   = at.session_state
+        course  = state["courses"].get(state["active_course"]) or {}
+        notes   = [f"{kind} {el.value!r}" for kind in ("error", "warning", "exception")
+                   for el in getattr(at, kind)]
+        return (f"page {state['page']}/{state['nav_section']}, "
+                f"{len(course.get('chunks', []))} chunk(s), "
+                f"{len(course.get('file_names', []))} file(s); "
+                + ("; ".join(notes) or "no warnings or errors"))
+    except Exception as err:                    # the session never got that far
+        return f"page state unavailable ({type(err).__name__}: {err})"
+
+
+def rss_mb():
+    """Resident memory of this process in MB (peak RSS where /proc is unavailable)."""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def deep_size(obj, seen=None):
+    """Approximate bytes held by `obj` and everything it references."""
+    import numpy as np
+    seen = set() if seen is None else seen
+    if id(obj) in seen or isinstance(obj, (type, type(sys), type(deep_size))):
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes + sys.getsizeof(obj)
+    size = sys.getsizeof(obj, 0)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(v, seen) for v in obj)
+    elif hasattr(obj, "__dict__"):
+        size += deep_size(vars(obj), seen)
+    elif hasattr(obj, "__slots__"):
+        size += sum(deep_size(getattr(obj, s), seen) for s in obj.__slots__ if hasattr(obj, s))
+    return size
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered) + 0.5) - 1))]
+
+
+def run_level(n, args, pdf_bytes, first):
+    """Run `n` concurrent visits and summarise them."""
+    gc.collect()
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n, thread_name_prefix="student") as pool:
+        visits = list(pool.map(lambda i: visit(first + i, args, pdf_bytes), range(n)))
+    wall = time.perf_counter() - started
+    gc.collect()
+    rss_after = rss_mb()
+
+    timings = [t for _, ts, _ in visits for t in ts]
+    seconds = [s for _, s in timings] or [0.0]
+    errors  = [e for _, _, e in visits if e]
+    state   = [deep_size(at.session_state.to_dict()) for at, _, _ in visits]
+    steps   = {}
+    for name in STEPS:
+        s = [sec for step, sec in timings if step == name]
+        if s:
+            steps[name] = {"p50_ms": percentile(s, 50) * 1000, "p99_ms": percentile(s, 99) * 1000}
+    return {
+        "sessions":        n,
+        "completed":       n - len(errors),
+        "errors":          errors[:5],
+        "wall_s":          wall,
+        "reruns":          len(timings),
+        "reruns_per_s":    len(timings) / wall,
+        "visits_per_min":  (n - len(errors)) / wall * 60,
+        "p50_ms":          percentile(seconds, 50) * 1000,
+        "p99_ms":          percentile(seconds, 99) * 1000,
+        "max_ms":          max(seconds) * 1000,
+        "rss_mb_per_session": max(0.0, rss_after - rss_before) / n,
+        "state_kb_per_session": sum(state) / len(state) / 1024,
+        "steps":           steps,
+    }
+
+
+def report(levels):
+    head = (f"{'sessions':>8}{'ok':>5}{'wall s':>8}{'reruns/s':>10}{'visits/min':>12}"
+            f"{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}{'RSS MB/sess':>13}{'state KB/sess':>15}")
+    print(head)
+    print("─" * len(head))
+    for r in levels:
+        print(f"{r['sessions']:>8}{r['completed']:>5}{r['wall_s']:>8.1f}{r['reruns_per_s']:>10.1f}"
+              f"{r['visits_per_min']:>12.1f}{r['p50_ms']:>9.0f}{r['p99_ms']:>9.0f}{r['max_ms']:>9.0f}"
+              f"{r['rss_mb_per_session']:>13.2f}{r['state_kb_per_session']:>15.1f}")
+    for r in levels:
+        for e in r["errors"]:
+            print(f"  {r['sessions']} sessions — failed visit: {e}")
+
+    last = levels[-1]
+    print(f"\nPer step at {last['sessions']} session(s):")
+    for name, s in last["steps"].items():
+        print(f"  {name:<16}p50 {s['p50_ms']:>8.0f} ms   p99 {s['p99_ms']:>8.0f} ms")
+
+
+def main():
+    args = parse_args()
+    try:
+        counts = [int(c) for c in args.sessions.split(",")]
+    except ValueError:
+        sys.exit(f"--sessions must be comma-separated numbers, got {args.sessions!r}")
+    workdir = tempfile.mkdtemp(prefix="alc-load-")
+    configure(args, workdir)
+
+    try:
+        # Running app.py outside `streamlit run` logs "missing ScriptRunContext" warnings
+        logging.disable(logging.WARNING)
+        warnings.filterwarnings("ignore", category=FutureWarning)
+        allow_concurrent_apptests()
+        with open(PDF, "rb") as fh:
+            pdf_bytes = fh.read()
+
+        # One untimed visit first: imports, first compile and discovery aren't per-session costs
+        _, _, err = visit(0, args, pdf_bytes)
+        if err:
+            sys.exit(f"Warm-up visit failed — {err}")
+
+        levels, first = [], 1
+        for n in counts:
+            levels.append(run_level(n, args, pdf_bytes, first))
+            first += n
+            print(f"… {n} session(s) done in {levels[-1]['wall_s']:.1f} s", file=sys.stderr)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\ncommit {git_commit() or '?'} · fake latency {args.latency_ms} ms + "
+          f"{args.ms_per_token} ms/token · error rate {args.error_rate} · think time "
+          f"{args.think_ms:g} ms · response cache {'off' if args.no_cache else 'on'}")
+    report(levels)
+
+    if args.out:
+        out = {"commit": git_commit(), "created": time.time(),
+               "config": {k: v for k, v in vars(args).items() if k != "out"},
+               "levels": levels}
+        with open(args.out, "w", encoding="utf-8") as fh:
+            json.dump(out, fh, indent=2)
+        print(f"\nSaved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()